@@ -6,16 +6,27 @@ note:
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
+import sys
+from functools import reduce
+
 try:
-    from yaml import load, FullLoader
+    sys.path.append("../../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../../Utils/' directory. Add it to run this script."
+    )
 
 try:
     from argparse import ArgumentParser
 except ModuleNotFoundError:
     print("Module 'argparse' is not installed. Please install it to run this script.")
 
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    print("Module 'numpy' is not installed. Please install it to run this script.")
+
 try:
     import pandas as pd
 except ModuleNotFoundError:
@@ -26,6 +37,46 @@ try:
 except ModuleNotFoundError:
     print("Module 'uproot' is not installed. Please install it to run this script.")
 
+STEP_SIZE: str = "500 MB"  # size of the chunks read from the input trees
+
+
+def to_dataframe(arrs: dict, refs_for_merge: list[str], suffix: str) -> pd.DataFrame:
+    """
+    Helper method to build the dataframe of a chunk of a tree, with the pair
+    of references packed into a single int64 key so that the join is done on
+    one integer column
+
+    Parameters
+    ------------------------------------------------
+    - arrs: dict
+        Arrays of the branches of the chunk
+
+    - refs_for_merge: list[str]
+        Names of the two branches the trees are merged on
+
+    - suffix: str
+        Suffix added to the names of the other branches
+
+    Returns
+    ------------------------------------------------
+    - df: pd.DataFrame
+        Dataframe with the '_key' column and the suffixed branches
+    """
+
+    keys: np.ndarray = arrs[refs_for_merge[0]].astype(np.int64) << 32
+    keys |= arrs[refs_for_merge[1]].astype(np.int64)
+
+    return pd.concat(
+        [pd.Series(keys, name="_key")]
+        + [
+            pd.Series(arr, name=name + suffix)
+            for name, arr in arrs.items()
+            if name not in refs_for_merge
+        ],
+        axis=1,
+        copy=False,
+    )
+
 
 def main(name_config_file: str, debug: bool) -> None:
     """
@@ -42,9 +93,7 @@ def main(name_config_file: str, debug: bool) -> None:
     if debug:
         print("Hello world!")
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     # handle input
     name_infile = config["input"]["file"]
@@ -53,55 +102,72 @@ def main(name_config_file: str, debug: bool) -> None:
     # handle df merge
     refs_for_merge: list[str] = config["merge"]["on_branches"]
     suffixes: list[str] = config["merge"]["suffixes"]
-    thresholds: list[str] = config["merge"]["thresholds"]
+    thresholds: list[float] = [float(thr) for thr in config["merge"]["thresholds"]]
     # handle output
     name_ofile = config["output"]["file"]
     name_otree: str = config["output"]["tree"]["name"]
     branch_of_interest: str = "TotalEnergyDeposit"
 
+    # read only the merge keys and the energy deposit, and apply the
+    # threshold of each tree chunk by chunk
+    needed: list[str] = refs_for_merge + [
+        name for name in name_branches if branch_of_interest in name
+    ]
     dfs: list[pd.DataFrame] = []
-    for name_tree, suffix in zip(name_trees, suffixes):
-        dfs.append(
-            uproot.open(name_infile)[name_tree].arrays(name_branches, library="pd")
-        )
-        new_names: dict = {}
-        for name_branch in name_branches:
-            if name_branch in refs_for_merge:
-                continue
-            new_names[name_branch] = name_branch + suffix
-        dfs[-1].rename(columns=new_names, inplace=True)
-
-    # merge dataframes per Run and per Event
-    df_merged: pd.DataFrame = pd.merge(*dfs, on=refs_for_merge)
-    if debug:
-        print(f"Merged dataframe: {df_merged}")
-
-    cols_to_keep = []
-    for name in list(df_merged.columns):
-        if name in refs_for_merge:
-            cols_to_keep.append(name)
-        elif branch_of_interest in name:
-            cols_to_keep.append(name)
-
-    df: pd.DataFrame = df_merged[cols_to_keep]
-    if debug:
-        print(f"Dataframe with selected columns: {df}")
-
-    # apply threshold
-    sel: str = str()
-    for i, (thr, suffix) in enumerate(zip(thresholds, suffixes)):
-        sel += branch_of_interest + suffix + f" > {thr}"
-        if i < len(suffixes) - 1:
-            sel += " and "
+    # open the input file only once, all the trees are read from it
+    with uproot.open(name_infile) as f_in:
+        for name_tree, suffix, thr in zip(name_trees, suffixes, thresholds):
+            tree = f_in[name_tree]
+            # the dtypes are taken from the tree, so that they are known even
+            # if no chunk is read
+            dtypes: dict = {name: tree[name].interpretation.to_dtype for name in needed}
+            dtype_refs: list = [dtypes[name] for name in refs_for_merge]
+            # stream the tree so that only one chunk is held in memory on top
+            # of the entries surviving the threshold
+            chunks: list[pd.DataFrame] = []
+            for arrs in tree.iterate(needed, step_size=STEP_SIZE, library="np"):
+                above_thr: np.ndarray = arrs[branch_of_interest] > thr
+                chunks.append(
+                    to_dataframe(
+                        {name: arr[above_thr] for name, arr in arrs.items()},
+                        refs_for_merge,
+                        suffix,
+                    )
+                )
+            if not chunks:
+                # empty tree, the columns are kept to write an empty output tree
+                chunks.append(
+                    to_dataframe(
+                        {name: np.empty(0, dtype=dtypes[name]) for name in needed},
+                        refs_for_merge,
+                        suffix,
+                    )
+                )
+            dfs.append(pd.concat(chunks, ignore_index=True, copy=False))
+
+    # merge dataframes per Run and per Event, the inner merge of the
+    # thresholded trees keeps the coincidences only
+    df_coinc: pd.DataFrame = reduce(
+        lambda df_left, df_right: pd.merge(
+            df_left, df_right, on="_key", how="inner", validate="one_to_one"
+        ),
+        dfs,
+    )
     if debug:
-        print(f"Selection: {sel}")
-    df_coinc: pd.DataFrame = df.query(sel, inplace=False)
-
-    if debug:
-        print(f"Size of df: {len(df)}\nSize of df_coinc: {len(df_coinc)}")
-
-    with uproot.recreate(name_ofile) as f:
-        f.mktree(name_otree, {col: df_coinc[col].to_numpy() for col in df.columns})
+        print(f"Size of df_coinc: {len(df_coinc)}")
+
+    # unpack the references straight into the output branches
+    keys = df_coinc["_key"].to_numpy()
+    branches_out: dict = {
+        refs_for_merge[0]: (keys >> 32).astype(dtype_refs[0]),
+        refs_for_merge[1]: (keys & 0xFFFFFFFF).astype(dtype_refs[1]),
+    }
+    for col in df_coinc.columns.drop("_key"):
+        branches_out[col] = df_coinc[col].to_numpy(copy=False)
+
+    # LZ4 is much cheaper than the default ZLIB for a similar compression factor
+    with uproot.recreate(name_ofile, compression=uproot.LZ4(4)) as f:
+        f[name_otree] = branches_out
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+"""
+file: sim_builder.py
+brief: Helpers shared by the simulation scripts to build the GATE simulation
+usage: imported by the simulation_*.py scripts
+note:
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+import sys
+from os import cpu_count
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    print("Module 'numpy' is not installed. Please install it to run this script.")
+
+try:
+    import opengate as gate
+except ModuleNotFoundError:
+    print("Module 'opengate' is not installed. Please install it to run this script.")
+
+try:
+    sys.path.append("../../Utils/")
+    from yaml_cache import load_yaml
+except ModuleNotFoundError:
+    print(
+        "Module 'yaml_cache' is not in the '../../Utils/' directory. Add it to run this script."
+    )
+
+try:
+    sys.path.append("../../Utils/")
+    from logger import Logger
+except ModuleNotFoundError:
+    print(
+        "Module 'logger' is not in the '../../Utils/' directory. Add it to run this script."
+    )
+
+# units
+MM = gate.g4_units.mm
+DEG = gate.g4_units.deg
+
+# description of a volume of the setup, one row per volume (lengths in mm)
+# - z_offset: distance to the previous volume, z positions are cumulated
+# - size: transverse size of a 'Box', outer radius of a 'TubsVolume'
+# - rmin: inner radius of a 'TubsVolume', unused for a 'Box'
+# - dz: thickness of a 'Box', dz of a 'TubsVolume', volume skipped if 0
+GEOMETRY_DTYPE = np.dtype(
+    [
+        ("name", "U16"),
+        ("kind", "U16"),
+        ("material", "U32"),
+        ("z_offset", "f8"),
+        ("size", "f8"),
+        ("rmin", "f8"),
+        ("dz", "f8"),
+    ]
+)
+
+
+def add_volumes(sim, geometry) -> dict:
+    """
+    Helper method to add the volumes described in a geometry table to the
+    simulation, placed along the beam axis
+
+    Parameters
+    ------------------------------------------------
+    - sim: gate.Simulation
+        Simulation object
+
+    - geometry: np.ndarray
+        Structured array of dtype GEOMETRY_DTYPE, one row per volume
+
+    Returns
+    ------------------------------------------------
+    - volumes: dict
+        Volumes added to the simulation, indexed by their name
+    """
+
+    z_volumes = np.cumsum(geometry["z_offset"]) * MM
+
+    volumes: dict = {}
+    for row, z_volume in zip(geometry, z_volumes):
+        if row["dz"] <= 0:
+            continue
+        name, kind = str(row["name"]), str(row["kind"])
+        volume = sim.add_volume(kind, name=name)
+        volume.mother = "world"
+        volume.material = str(row["material"])
+        if kind == "Box":
+            volume.size = [row["size"] * MM, row["size"] * MM, row["dz"] * MM]
+        elif kind == "TubsVolume":
+            volume.rmin = row["rmin"] * MM
+            volume.rmax = row["size"] * MM
+            volume.dz = row["dz"] * MM
+            volume.sphi = 0
+            volume.dphi = 360 * DEG
+        else:
+            Logger(f"Volume kind '{kind}' of volume '{name}' not supported", "FATAL")
+        volume.translation = [0, 0, float(z_volume)]
+        volumes[name] = volume
+
+    return volumes
+
+
+def configure_ui(sim, dir_output: str) -> None:
+    """
+    Helper method to set the verbosity, visualisation, random engine and
+    output options of the simulation
+
+    Parameters
+    ------------------------------------------------
+    - sim: gate.Simulation
+        Simulation object
+
+    - dir_output: str
+        Directory where the output files are written
+    """
+
+    sim.verbose_level = gate.logger.DEBUG
+    sim.running_verbose_level = 0  # gate.logger.RUN
+    sim.g4_verbose = False
+    sim.g4_verbose_level = 1
+    sim.visu = False
+    sim.visu_type = "qt"  # vrml
+    sim.random_engine = "MersenneTwister"
+    sim.random_seed = "auto"
+    sim.output_dir = dir_output
+
+
+def build_base_sim(config: dict):
+    """
+    Helper method to create the simulation object with the settings shared by
+    all the setups: materials, UI and physics list
+
+    Parameters
+    ------------------------------------------------
+    - config: dict
+        Content of the YAML config file
+
+    Returns
+    ------------------------------------------------
+    - sim: gate.Simulation
+        Simulation object, without volumes, sources and actors
+    """
+
+    # create simulation object
+    sim = gate.Simulation()
+
+    # import materials definitions
+    sim.volume_manager.add_material_database("./MaterialsCLINM.db")
+
+    # ui
+    configure_ui(sim, config["output"]["dir"])
+
+    # multithreading, QGSP_INCLXX_HP is thread safe
+    sim.number_of_threads = config.get("n_threads", cpu_count())
+
+    # physics list
+    sim.physics_manager.physics_list_name = "QGSP_INCLXX_HP"
+
+    return sim
+
+
+def add_hits_actors(sim, volumes: list, name_ofile: str) -> list:
+    """
+    Helper method to record the hits in some volumes and the total energy
+    deposited inside each of them during an event
+
+    Parameters
+    ------------------------------------------------
+    - sim: gate.Simulation
+        Simulation object
+
+    - volumes: list
+        Volumes where the hits are recorded
+
+    - name_ofile: str
+        Name of the output file, shared by all the actors
+
+    Returns
+    ------------------------------------------------
+    - actors: list
+        Actors writing into the output file
+    """
+
+    actors: list = []
+    for volume in volumes:
+        suffix: str = volume.name.capitalize()
+        # first, define HitsCollectionActor
+        hits = sim.add_actor("DigitizerHitsCollectionActor", name=f"Hits{suffix}")
+        hits.attached_to = volume
+        hits.output_filename = name_ofile
+        hits.attributes = [
+            "TotalEnergyDeposit",
+            "KineticEnergy",
+            "RunID",
+            "ThreadID",
+            "TrackID",
+            "EventID",
+            "PostPosition",
+            "PreStepUniqueVolumeID",
+            "GlobalTime",
+        ]
+        # then, define Adder to get the total energy deposited inside a detector during an event
+        hits_adder = sim.add_actor("DigitizerAdderActor", name=f"HitsAdder{suffix}")
+        hits_adder.input_digi_collection = hits.name
+        hits_adder.group_volume = volume.name
+        hits_adder.output_filename = name_ofile
+        hits_adder.policy = "EnergyWeightedCentroidPosition"
+        actors += [hits, hits_adder]
+
+    # TODO add later on
+    # hits_cebr3 = sim.add_actor("DigitizerHitsCollectionActor", name="HitsCeBr3")
+    # hits_cebr3.attached_to = cebr3
+    # hits_cebr3.output_filename = f"HitsCeBr3_{campaign}_Run{run}.root"
+    # hits_cebr3.attributes = [
+    #     "TotalEnergyDeposit",
+    #     "KineticEnergy",
+    #     "RunID",
+    #     "ThreadID",
+    #     "TrackID",
+    #     "EventID",
+    # ]
+
+    return actors
+
+
+def run_configs(
+    name_config_files: list[str],
+    build_sim,
+    run_one,
+    static_keys: list[str],
+    n_threads: int = 0,
+) -> None:
+    """
+    Helper method to run one simulation per config file, the simulation
+    objects being built on the Python side only once for a scan over the
+    source parameters or the runs. Geant4 is still initialised for each run,
+    in a new process as soon as there are several configs
+
+    Parameters
+    ------------------------------------------------
+    - name_config_files: list[str]
+        Names of the YAML config files, one per simulation to run
+
+    - build_sim: callable
+        Function building the simulation objects from a config
+
+    - run_one: callable
+        Function updating the simulation objects with a config and running
+        the simulation
+
+    - static_keys: list[str]
+        Entries of the config that require building the simulation again
+        when they change from one config to the next one
+
+    - n_threads: int
+        Number of threads of each simulation, overriding the one of the
+        configs if larger than 0
+    """
+
+    # Geant4 cannot be initialised twice in the same process, each run is
+    # then done in a new process as soon as there are several of them
+    start_new_process: bool = len(name_config_files) > 1
+
+    sim_objects: tuple = ()
+    static_prev: dict = {}
+    for name_config_file in name_config_files:
+        config: dict = load_yaml(name_config_file)
+        if n_threads > 0:
+            config["n_threads"] = n_threads
+        static: dict = {key: config.get(key) for key in ["n_threads", *static_keys]}
+        if not sim_objects or static != static_prev:
+            sim_objects = build_sim(config)
+            static_prev = static
+        run_one(sim_objects, config, start_new_process)
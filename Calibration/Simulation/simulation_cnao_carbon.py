@@ -1,29 +1,39 @@
 """
 file: simulation.py
 brief:
-usage: python3 simulation.py cfg.yml
+usage: python3 simulation.py cfg.yml [cfg2.yml ...]
 note:
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
-# import sys
-from os import system
-
 try:
-    from yaml import load, FullLoader
+    from argparse import ArgumentParser
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from argparse import ArgumentParser
+    import numpy as np
 except ModuleNotFoundError:
-    print("Module 'argparse' is not installed. Please install it to run this script.")
+    print("Module 'numpy' is not installed. Please install it to run this script.")
 
 try:
     import opengate as gate
 except ModuleNotFoundError:
     print("Module 'opengate' is not installed. Please install it to run this script.")
 
+try:
+    from sim_builder import (
+        GEOMETRY_DTYPE,
+        add_hits_actors,
+        add_volumes,
+        build_base_sim,
+        run_configs,
+    )
+except ModuleNotFoundError:
+    print(
+        "Module 'sim_builder' is not in the current directory. Add it to run this script."
+    )
+
 # units
 MM = gate.g4_units.mm
 CM = gate.g4_units.cm
@@ -31,103 +41,41 @@ M = gate.g4_units.m
 DEG = gate.g4_units.deg
 MEV = gate.g4_units.MeV
 
-
-# pylint:disable=too-many-locals,too-many-statements
-def main(name_config_file: str, debug: bool) -> None:
+# volumes, the offsets being the distances between the centres of the volumes
+GEOMETRY = np.array(
+    [
+        ("plastic1", "Box", "G4_PLASTIC_SC_VINYLTOLUENE", 740.0, 60.0, 0.0, 2.0),
+        ("plastic2", "Box", "G4_PLASTIC_SC_VINYLTOLUENE", 33.0, 60.0, 0.0, 4.0),
+        # ("alu", "TubsVolume", "Aluminium", 67.0, 51.0, 0.0, 0.5),
+        # ("teflon", "TubsVolume", "Teflon", 1.0, 51.0, 0.0, 0.5),  # 0.8 mm
+        # we do not need CeBr3 here as we only want to calibrate the plastic detectors
+        # ("cebr3", "TubsVolume", "CeBr3", 26.0, 51.0, 0.0, 25.5),
+    ],
+    dtype=GEOMETRY_DTYPE,
+)
+
+
+def build_sim(config: dict) -> tuple:
     """
-    Main function
+    Build the simulation: materials, UI, physics list, volumes, source and
+    actors
 
     Parameters
     ------------------------------------------------
-    - name_config_file: str
-        Name of the YAML config file
+    - config: dict
+        Content of the YAML config file
 
-    - debug: bool
-        Switch for debugging
+    Returns
+    ------------------------------------------------
+    - sim_objects: tuple
+        Simulation object, source and actors writing the output file
     """
-    if debug:
-        print("DEBUG mode enabled!")
-    # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
-
-    campaign: str = config["campaign"]
-    run = config["run"]
-    energy_source: str = config["source"]["energy"]
-    n_source: int = config["source"]["n"]
-    dir_output: str = config["output"]["dir"]
 
-    # create simulation object
-    sim: gate.Simulation = gate.Simulation()
-
-    # import materials definitions
-    sim.volume_manager.add_material_database("./MaterialsCLINM.db")
-
-    # ui
-    sim.verbose_level = gate.logger.DEBUG
-    sim.running_verbose_level = 0  # gate.logger.RUN
-    sim.g4_verbose = False
-    sim.g4_verbose_level = 1
-    sim.visu = False
-    sim.visu_type = "qt"  # vrml
-    sim.random_engine = "MersenneTwister"
-    sim.random_seed = "auto"
-    sim.output_dir = dir_output
+    # create simulation object, with materials, UI and physics list
+    sim = build_base_sim(config)
 
     # volumes
-
-    z_plastic1 = 740 * MM
-    z_plastic2 = z_plastic1 + 33 * MM
-    # z_alu = z_plastic2 + 67 * MM
-    # z_teflon = z_alu + 1 * MM  # 0.8 * MM
-    # z_cebr3 = z_teflon + 26 * MM
-
-    plastic1 = sim.add_volume("Box", name="plastic1")
-    plastic1.mother = "world"
-    plastic1.material = "G4_PLASTIC_SC_VINYLTOLUENE"
-    plastic1.size = [6 * CM, 6 * CM, 2 * MM]
-    plastic1.translation = [0, 0, z_plastic1]
-
-    plastic2 = sim.add_volume("Box", name="plastic2")
-    plastic2.mother = "world"
-    plastic2.material = "G4_PLASTIC_SC_VINYLTOLUENE"
-    plastic2.size = [6 * CM, 6 * CM, 4 * MM]
-    plastic2.translation = [0, 0, z_plastic2]
-
-    # alu = sim.add_volume("TubsVolume", name="alu")
-    # alu.mother = "world"
-    # alu.material = "Aluminium"
-    # alu.rmin = 0
-    # alu.rmax = 51 * MM
-    # alu.dz = 0.5 * MM
-    # alu.sphi = 0
-    # alu.dphi = 360 * DEG
-    # alu.translation = [0, 0, z_alu]
-
-    # teflon = sim.add_volume("TubsVolume", name="teflon")
-    # teflon.mother = "world"
-    # teflon.material = "Teflon"
-    # teflon.rmin = 0
-    # teflon.rmax = 51 * MM
-    # teflon.dz = 0.5 * MM
-    # teflon.sphi = 0
-    # teflon.dphi = 360 * DEG
-    # teflon.translation = [0, 0, z_teflon]
-
-    # we do not need CeBr3 here as we only want to calibrate the plastic detectors
-    # cebr3 = sim.add_volume("TubsVolume", name="cebr3")
-    # cebr3.mother = "world"
-    # cebr3.material = "CeBr3"
-    # cebr3.rmin = 0
-    # cebr3.rmax = 51 * MM
-    # cebr3.dz = 25.5 * MM
-    # cebr3.sphi = 0
-    # cebr3.dphi = 360 * DEG
-    # cebr3.translation = [0, 0, z_cebr3]
-
-    # physics list
-    sim.physics_manager.physics_list_name = "QGSP_INCLXX_HP"
+    volumes: dict = add_volumes(sim, GEOMETRY)
 
     # source
     source = sim.add_source("GenericSource", name="CNAO")
@@ -136,57 +84,13 @@ def main(name_config_file: str, debug: bool) -> None:
     source.ion.A = 12
     source.ion.Q = 6
     source.ion.E = 0
-    source.energy.mono = (energy_source * MEV) * source.ion.A  # in MeV, not in MeV/u !
     source.position.type = "point"
     source.position.center = [0, 0, 0]
     source.direction.type = "momentum"
     source.direction.momentum = [0, 0, 1]
-    source.n = n_source
 
-    name_ofile_plastics = f"{campaign}_Run{run}_MC.root"
     # actors
-    # first, define HitsCollectionActors
-    hits_plastic1 = sim.add_actor("DigitizerHitsCollectionActor", name="HitsPlastic1")
-    hits_plastic1.attached_to = plastic1
-    hits_plastic1.output_filename = name_ofile_plastics
-    hits_plastic1.attributes = [
-        "TotalEnergyDeposit",
-        "KineticEnergy",
-        "RunID",
-        "ThreadID",
-        "TrackID",
-        "EventID",
-        "PostPosition",
-        "PreStepUniqueVolumeID",
-        "GlobalTime",
-    ]
-
-    hits_plastic2 = sim.add_actor("DigitizerHitsCollectionActor", name="HitsPlastic2")
-    hits_plastic2.attached_to = plastic2
-    hits_plastic2.output_filename = name_ofile_plastics
-    hits_plastic2.attributes = [
-        "TotalEnergyDeposit",
-        "KineticEnergy",
-        "RunID",
-        "ThreadID",
-        "TrackID",
-        "EventID",
-        "PostPosition",
-        "PreStepUniqueVolumeID",
-        "GlobalTime",
-    ]
-    # then, define Adder to get the total energy deposited inside a detector during an event
-    hits_adder_plastic1 = sim.add_actor("DigitizerAdderActor", name="HitsAdderPlastic1")
-    hits_adder_plastic1.input_digi_collection = "HitsPlastic1"
-    hits_adder_plastic1.group_volume = plastic1.name
-    hits_adder_plastic1.output_filename = name_ofile_plastics
-    hits_adder_plastic1.policy = "EnergyWeightedCentroidPosition"
-
-    hits_adder_plastic2 = sim.add_actor("DigitizerAdderActor", name="HitsAdderPlastic2")
-    hits_adder_plastic2.input_digi_collection = "HitsPlastic2"
-    hits_adder_plastic2.group_volume = plastic2.name
-    hits_adder_plastic2.output_filename = name_ofile_plastics
-    hits_adder_plastic2.policy = "EnergyWeightedCentroidPosition"
+    actors: list = add_hits_actors(sim, [volumes["plastic1"], volumes["plastic2"]], "")
 
     # try with attachment to both of the scintillators
     # hits_plastics = sim.add_actor("DigitizerHitsCollectionActor", name="HitsPlastics")
@@ -212,34 +116,70 @@ def main(name_config_file: str, debug: bool) -> None:
     # hits_adder_plastics.output_filename = name_ofile_plastics
     # hits_adder_plastics.policy = "EnergyWeightedCentroidPosition"
 
-    # TODO add later on
-    # hits_cebr3 = sim.add_actor("DigitizerHitsCollectionActor", name="HitsCeBr3")
-    # hits_cebr3.attached_to = cebr3
-    # hits_cebr3.output_filename = f"HitsCeBr3_{campaign}_Run{run}.root"
-    # hits_cebr3.attributes = [
-    #     "TotalEnergyDeposit",
-    #     "KineticEnergy",
-    #     "RunID",
-    #     "ThreadID",
-    #     "TrackID",
-    #     "EventID",
-    # ]
+    return sim, source, actors
+
+
+def run_one(sim_objects: tuple, config: dict, start_new_process: bool) -> None:
+    """
+    Set the source, run and output of the simulation and run it
+
+    Parameters
+    ------------------------------------------------
+    - sim_objects: tuple
+        Simulation object, source and actors returned by build_sim
+
+    - config: dict
+        Content of the YAML config file
+
+    - start_new_process: bool
+        Switch to run the simulation in a new process
+    """
+
+    sim, source, actors = sim_objects
+
+    campaign: str = config["campaign"]
+    run = config["run"]
+    energy_source: str = config["source"]["energy"]
+    n_source: int = config["source"]["n"]
+
+    sim.output_dir = config["output"]["dir"]
+    source.energy.mono = (energy_source * MEV) * source.ion.A  # in MeV, not in MeV/u !
+    source.n = n_source
+    for actor in actors:
+        actor.output_filename = f"{campaign}_Run{run}_MC.root"
 
     # run simulation
-    sim.run()
+    sim.run(start_new_process=start_new_process)
+
+
+def main(name_config_files: list[str], debug: bool, n_threads: int = 0) -> None:
+    """
+    Main function
+
+    Parameters
+    ------------------------------------------------
+    - name_config_files: list[str]
+        Names of the YAML config files, one per simulation to run
+
+    - debug: bool
+        Switch for debugging
+
+    - n_threads: int
+        Number of threads of each simulation, taken from the configs if 0
+    """
+    if debug:
+        print("DEBUG mode enabled!")
 
-    # TODO remove this paragraph ; merge output files
-    # name_ofile = f"{dir_output}/Hits_{campaign}_Run{run}.root"
-    # cmd_merge = (
-    #     f"hadd {name_ofile} {dir_output}/{name_ofile_pl1} {dir_output}/{name_ofile_pl2}"
-    # )
-    # print(f"Merging output files into {name_ofile}: ")
-    # system(cmd_merge)
+    run_configs(
+        name_config_files, build_sim, run_one, static_keys=[], n_threads=n_threads
+    )
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Arguments")
-    parser.add_argument("name_config_file", metavar="text", default="config.yaml")
+    parser.add_argument(
+        "name_config_files", metavar="text", nargs="+", default="config.yaml"
+    )
     args = parser.parse_args()
     DEBUG: bool = True
-    main(args.name_config_file, DEBUG)
+    main(args.name_config_files, DEBUG)
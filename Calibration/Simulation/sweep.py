@@ -0,0 +1,111 @@
+"""
+file: sweep.py
+brief: Run several simulations in parallel, one process per config file
+usage: python3 sweep.py cfg_sweep.yml
+note: each simulation runs in a fresh process so that no Geant4 state is
+      shared between two simulations
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+import sys
+from importlib import import_module
+from multiprocessing import get_context
+from os import cpu_count
+
+try:
+    sys.path.append("../../Utils/")
+    from yaml_cache import load_yaml
+except ModuleNotFoundError:
+    print(
+        "Module 'yaml_cache' is not in the '../../Utils/' directory. Add it to run this script."
+    )
+
+try:
+    sys.path.append("../../Utils/")
+    from logger import Logger
+except ModuleNotFoundError:
+    print(
+        "Module 'logger' is not in the '../../Utils/' directory. Add it to run this script."
+    )
+
+try:
+    from argparse import ArgumentParser
+except ModuleNotFoundError:
+    print("Module 'argparse' is not installed. Please install it to run this script.")
+
+POSSIBLE_SIMULATIONS: list[str] = [
+    "simulation_cnao_carbon",
+    "simulation_cnao_proton",
+    "simulation_cyrce",
+]
+
+
+def run_one_config(args: tuple) -> None:
+    """
+    Run the simulation of one config file
+
+    Parameters
+    ------------------------------------------------
+    - args: tuple
+        Name of the simulation module, name of the YAML config file and number
+        of threads of the simulation
+    """
+
+    name_simulation, name_config_file, n_threads = args
+    import_module(name_simulation).main([name_config_file], False, n_threads)
+
+
+def main(name_config_file: str, debug: bool) -> None:
+    """
+    Main function
+
+    Parameters
+    ------------------------------------------------
+    - name_config_file: str
+        Name of the YAML config file of the sweep
+
+    - debug: bool
+        Switch for debugging
+    """
+
+    config: dict = load_yaml(name_config_file)
+
+    name_simulation: str = config["simulation"]
+    name_config_files: list[str] = config["configs"]
+    n_cores: int = cpu_count() or 1
+    n_processes = config.get("n_processes")
+    if n_processes is None:
+        n_processes = max(1, n_cores // 2)
+    if not isinstance(n_processes, int) or n_processes < 1:
+        Logger(f"'n_processes' must be a positive integer, not {n_processes}", "FATAL")
+    # share the cores between the processes to avoid oversubscription
+    n_threads: int = max(1, n_cores // n_processes)
+
+    # safety
+    if name_simulation not in POSSIBLE_SIMULATIONS:
+        Logger(
+            f"Simulation '{name_simulation}' not in {POSSIBLE_SIMULATIONS}", "FATAL"
+        )
+
+    if debug:
+        Logger(
+            f"Running {len(name_config_files)} simulations with {n_processes} processes",
+            "INFO",
+        )
+
+    # 'spawn' and one task per child, so that each simulation starts from a
+    # clean Geant4 state
+    with get_context("spawn").Pool(processes=n_processes, maxtasksperchild=1) as pool:
+        pool.map(
+            run_one_config,
+            [(name_simulation, name, n_threads) for name in name_config_files],
+            chunksize=1,
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Arguments")
+    parser.add_argument("name_config_file", metavar="text", default="config.yaml")
+    args = parser.parse_args()
+    DEBUG: bool = True
+    main(args.name_config_file, DEBUG)
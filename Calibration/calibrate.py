@@ -7,14 +7,12 @@ author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 import numpy as np
 import ROOT as r
-
-try:
-    from yaml import load, FullLoader
-except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+from numpy.lib.recfunctions import structured_to_unstructured
 
 try:
     from argparse import ArgumentParser
@@ -22,17 +20,20 @@ except ModuleNotFoundError:
     print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    import pandas as pd
+    import uproot
 except ModuleNotFoundError:
-    print("Module 'pandas' is not installed. Please install it to run this script.")
+    print("Module 'uproot' is not installed. Please install it to run this script.")
+
+sys.path.append("../Utils/")
 
 try:
-    import uproot
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'uproot' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
-    sys.path.append("../Utils/")
     from logger import Logger
 except ModuleNotFoundError:
     print(
@@ -40,15 +41,13 @@ except ModuleNotFoundError:
     )
 
 try:
-    sys.path.append("../Utils/")
-    from utils import fill_th1, get_h_config, enforce_list
+    from fit_utils import BIRKS_LAW, fit_birks
 except ModuleNotFoundError:
     print(
-        "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
+        "Module 'fit_utils' is not in the '../Utils/' directory. Add it to run this script."
     )
 
 try:
-    sys.path.append("../Utils/")
     from style_formatter import set_global_style, set_object_style
 except ModuleNotFoundError:
     print(
@@ -56,23 +55,158 @@ except ModuleNotFoundError:
     )
 
 
-# pylint:disable=too-few-public-methods
-class BirksLaw:
+# means and sigmas of the fits of real and simulated data, one row per pair of
+# real and simulated input files, the names being kept as objects so that they
+# are never truncated
+FITRES_DTYPE = np.dtype(
+    [
+        ("ion", object),
+        ("campaign", object),
+        ("mean_real", "f8"),
+        ("sigma_real", "f8"),
+        ("mean_simu", "f8"),
+        ("sigma_simu", "f8"),
+    ]
+)
+
+
+def read_fitres(
+    name_infile: str, name_hists: list[str], number_mean_bin: int, number_sigma_bin: int
+) -> dict:
+    """
+    Helper method to read the mean and the sigma stored in the histograms of
+    fit results of an input file, opening the file only once
+
+    Parameters
+    ------------------------------------------------
+    - name_infile: str
+        Name of the input file
+
+    - name_hists: list[str]
+        Names of the histograms of fit results
+
+    - number_mean_bin: int
+        Number of the bin storing the mean
+
+    - number_sigma_bin: int
+        Number of the bin storing the sigma
+
+    Returns
+    ------------------------------------------------
+    - fitres: dict
+        (mean, sigma) read from each histogram, indexed by its name
+    """
+
+    fitres: dict = {}
+    with uproot.open(name_infile) as infile:
+        for name_hist in name_hists:
+            # single read of all the bins, flow bins included so that the
+            # array is indexed like ROOT bin numbers
+            values: np.ndarray = infile[name_hist].values(flow=True)
+            fitres[name_hist] = (values[number_mean_bin], values[number_sigma_bin])
+
+    return fitres
+
+
+def tabulate_fitres(
+    name_infiles_real: dict,
+    name_infiles_simu: dict,
+    name_hist_fitres_real: str,
+    name_hist_fitres_simu: str,
+    fitres: dict,
+) -> np.ndarray:
+    """
+    Helper method to gather the means and the sigmas read from the input
+    files in a single table, one row per pair of real and simulated files
+
+    Parameters
+    ------------------------------------------------
+    - name_infiles_real: dict
+        Real data input files, per ion and per campaign
+
+    - name_infiles_simu: dict
+        Simulated data input files, per ion and per campaign
+
+    - name_hist_fitres_real: str
+        Name of the histogram of fit results of real data
+
+    - name_hist_fitres_simu: str
+        Name of the histogram of fit results of simulated data
+
+    - fitres: dict
+        (mean, sigma) read from each (file, histogram of fit results)
+
+    Returns
+    ------------------------------------------------
+    - table: np.ndarray
+        Structured array of dtype FITRES_DTYPE
+    """
+
+    n_rows: int = sum(
+        len(name_infiles_campaign)
+        for dict_campaign in name_infiles_real.values()
+        for name_infiles_campaign in dict_campaign.values()
+    )
+    table: np.ndarray = np.empty(n_rows, dtype=FITRES_DTYPE)
+
+    irow: int = 0
+    for ion, dict_campaign in name_infiles_real.items():
+        for campaign, name_infiles_campaign_real in dict_campaign.items():
+            name_infiles_campaign_simu = name_infiles_simu[ion][campaign]
+            if len(name_infiles_campaign_real) != len(name_infiles_campaign_simu):
+                Logger(
+                    f"'input/real/file/{ion}/{campaign}' and "
+                    f"'input/simulation/file/{ion}/{campaign}' entries must be of"
+                    " same size!",
+                    "FATAL",
+                )
+            for name_infile_real, name_infile_simu in zip(
+                name_infiles_campaign_real, name_infiles_campaign_simu
+            ):
+                table[irow] = (
+                    ion,
+                    campaign,
+                    *fitres[(name_infile_real, name_hist_fitres_real)],
+                    *fitres[(name_infile_simu, name_hist_fitres_simu)],
+                )
+                irow += 1
+
+    return table
+
+
+def stage_input(name_infile: str) -> str:
     """
-    Class to define Birks law for calibration fit
+    Helper method to copy a remote input file into the local cache directory
+    of ROOT, set with TFile::SetCacheFileDir
+
+    Parameters
+    ------------------------------------------------
+    - name_infile: str
+        Name of the input file
+
+    Returns
+    ------------------------------------------------
+    - name_local_infile: str
+        Name of the local copy of the input file, the input file itself if
+        it is already local
     """
 
-    def __call__(self, x, par):
-        edep = x[0]
-        s = par[0]
-        a0 = par[1]
-        kb = par[2]
+    if "://" not in name_infile:
+        return name_infile
 
-        return (s * edep + a0) / (1 + kb * edep)
+    # CACHEREAD downloads the file on first use only, the cached copy is
+    # fetched again if its UUID differs from the one of the remote file
+    infile: r.TFile = r.TFile.Open(name_infile, "CACHEREAD")
+    if not infile or infile.IsZombie():
+        Logger(f"Could not open input file '{name_infile}'", "FATAL")
+    name_local_infile: str = infile.GetName()
+    infile.Close()
+
+    return name_local_infile
 
 
 # pylint:disable=too-many-locals
-def main(name_config_file: str) -> None:
+def main(name_config_file: str, dir_cache: str = "") -> None:
     """
     Main function
 
@@ -80,6 +214,9 @@ def main(name_config_file: str) -> None:
     ------------------------------------------------
     - name_config_file: str
         Name of the YAML config file
+
+    - dir_cache: str
+        Directory where the remote input files are cached, no cache if empty
     """
     padleftmargin = 0.12
     set_global_style(
@@ -93,9 +230,7 @@ def main(name_config_file: str) -> None:
     )
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     # handle input
     name_infiles_real: dict = config["input"]["real"]["file"]
@@ -114,8 +249,10 @@ def main(name_config_file: str) -> None:
     limits_yaxis: str = config["graph"]["limits"]["yaxis"]
     color_graph: dict = config["graph"]["color"]
     markerstyle_graph: dict = config["graph"]["markerstyle"]
+    legend_graph: dict = config["graph"]["legend"]
     # fit options
     color_fit: dict = config["fit"]["color"]
+    range_fit: dict = config["fit"]["range"]
 
     # TLatex options
     xmin_tlatex: dict = config["tlatex"]["xmin"]
@@ -159,112 +296,101 @@ def main(name_config_file: str) -> None:
 
     # campaigns = list(name_infiles_real.keys())
 
-    means_real = {}
-    sigmas_real = {}
-    means_simu = {}
-    sigmas_simu = {}
+    # gather the histograms of fit results to read per input file, so that a
+    # file shared by the real and the simulated data, or by several ions or
+    # campaigns, is opened only once
+    name_hists_per_file: dict = {}
+    for name_infiles, name_hist in [
+        (name_infiles_real, name_hist_fitres_real),
+        (name_infiles_simu, name_hist_fitres_simu),
+    ]:
+        for dict_campaign in name_infiles.values():
+            for name_infiles_campaign in dict_campaign.values():
+                for name_infile in name_infiles_campaign:
+                    name_hists_per_file.setdefault(name_infile, {})[name_hist] = None
+
+    name_infiles_read: list[str] = list(name_hists_per_file)
+    if dir_cache:
+        r.TFile.SetCacheFileDir(dir_cache)
+        name_infiles_read = [stage_input(name) for name in name_infiles_read]
+
+    # uproot releases the GIL while reading and decompressing, the inputs are
+    # then read concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        fitres_per_file = executor.map(
+            read_fitres,
+            name_infiles_read,
+            [list(name_hists) for name_hists in name_hists_per_file.values()],
+            repeat(number_mean_bin),
+            repeat(number_sigma_bin),
+        )
+        fitres: dict = {
+            (name_infile, name_hist): fitres_hist
+            for name_infile, fitres_file in zip(name_hists_per_file, fitres_per_file)
+            for name_hist, fitres_hist in fitres_file.items()
+        }
+
+    fitres_table: np.ndarray = tabulate_fitres(
+        name_infiles_real,
+        name_infiles_simu,
+        name_hist_fitres_real,
+        name_hist_fitres_simu,
+        fitres,
+    )
+
+    # (x, y, unc_x, unc_y) of all the points as the rows of a single float64
+    # block, selecting columns of the block with a mask gives contiguous rows
+    # that are handed as is to TGraphErrors
+    points: np.ndarray = np.ascontiguousarray(
+        structured_to_unstructured(
+            fitres_table[["mean_simu", "mean_real", "sigma_simu", "sigma_real"]]
+        ).T,
+        dtype=np.float64,
+    )
+
+    # create TGraphErrors for plot, the points of each campaign are kept to
+    # build the ones for fit without going through the table again
+    graphs_for_plot = {}
+    points_per_ion: dict = {ion: [] for ion in ions}
 
     for ion, dict_campaign in name_infiles_real.items():
-        means_real[ion] = {}
-        sigmas_real[ion] = {}
-        for campaign, name_infiles_campaign in dict_campaign.items():
-            means_real[ion][campaign] = []
-            sigmas_real[ion][campaign] = []
-            for name_infile_real in name_infiles_campaign:
-                infile_real: r.TFile = r.TFile.Open(name_infile_real)
-                hist_real: r.TH1 = infile_real.Get(name_hist_fitres_real)
-                means_real[ion][campaign].append(
-                    hist_real.GetBinContent(number_mean_bin)
-                )
-                sigmas_real[ion][campaign].append(
-                    hist_real.GetBinContent(number_sigma_bin)
-                )
-                infile_real.Close()
-
-    for ion, dict_campaign in name_infiles_simu.items():
-        means_simu[ion] = {}
-        sigmas_simu[ion] = {}
-        for campaign, name_infiles_campaign in dict_campaign.items():
-            means_simu[ion][campaign] = []
-            sigmas_simu[ion][campaign] = []
-            for name_infile_simu in name_infiles_campaign:
-                infile_simu: r.TFile = r.TFile.Open(name_infile_simu)
-                hist_simu: r.TH1 = infile_simu.Get(name_hist_fitres_simu)
-                means_simu[ion][campaign].append(
-                    hist_simu.GetBinContent(number_mean_bin)
-                )
-                sigmas_simu[ion][campaign].append(
-                    hist_simu.GetBinContent(number_sigma_bin)
-                )
-                infile_simu.Close()
+        color_graph_ion: dict = color_graph[ion]
+        markerstyle_graph_ion: dict = markerstyle_graph[ion]
+        for campaign in dict_campaign:
+            mask = (fitres_table["ion"] == ion) & (fitres_table["campaign"] == campaign)
+            points_campaign: np.ndarray = points[:, mask]
+            graph = r.TGraphErrors(points_campaign.shape[1], *points_campaign)
+            graph.SetName(f"{name_graph}_{ion}_{campaign}")
+            graph.GetXaxis().SetTitle(label_xaxis)
+            graph.GetYaxis().SetTitle(label_yaxis)
+            graph.GetXaxis().SetLimits(*limits_xaxis)
+            graph.GetYaxis().SetRangeUser(*limits_yaxis)
+            set_object_style(
+                obj=graph,
+                color=color_graph_ion[campaign],
+                markerstyle=markerstyle_graph_ion[campaign],
+            )
+            graphs_for_plot[(ion, campaign)] = graph
+            points_per_ion[ion].append(points_campaign)
 
     # create TGraphErrors for fit
-    x, unc_x = {}, {}
-    y, unc_y = {}, {}
     graphs_for_fit = {}
+    data_for_fit: dict = {}
 
-    for ion, dict_mean in means_simu.items():
-        x[ion] = []
-        unc_x[ion] = []
-        y[ion] = []
-        unc_y[ion] = []
-        for campaign, _ in dict_mean.items():
-            x[ion].extend(means_simu[ion][campaign])
-            unc_x[ion].extend(sigmas_simu[ion][campaign])
-            y[ion].extend(means_real[ion][campaign])
-            unc_y[ion].extend(sigmas_real[ion][campaign])
-        x[ion] = np.array(x[ion])
-        unc_x[ion] = np.array(unc_x[ion])
-        y[ion] = np.array(y[ion])
-        unc_y[ion] = np.array(unc_y[ion])
+    for ion, points_ion in points_per_ion.items():
+        data_for_fit[ion] = tuple(np.concatenate(points_ion, axis=1))
         graphs_for_fit[ion] = r.TGraphErrors(
-            len(x[ion]), x[ion], y[ion], unc_x[ion], unc_y[ion]
+            len(data_for_fit[ion][0]), *data_for_fit[ion]
         )
         graphs_for_fit[ion].SetName(f"{name_graph}_{ion}")
 
-    # create TGraphErrors for plot
-    x, unc_x = {}, {}
-    y, unc_y = {}, {}
-    graphs_for_plot = {}
-
-    for ion, dict_mean in means_simu.items():
-        for campaign, _ in dict_mean.items():
-            x[f"{ion}_{campaign}"] = np.array(means_simu[ion][campaign])
-            unc_x[f"{ion}_{campaign}"] = np.array(sigmas_simu[ion][campaign])
-            y[f"{ion}_{campaign}"] = np.array(means_real[ion][campaign])
-            unc_y[f"{ion}_{campaign}"] = np.array(sigmas_real[ion][campaign])
-            graphs_for_plot[f"{ion}_{campaign}"] = r.TGraphErrors(
-                len(x[f"{ion}_{campaign}"]),
-                x[f"{ion}_{campaign}"],
-                y[f"{ion}_{campaign}"],
-                unc_x[f"{ion}_{campaign}"],
-                unc_y[f"{ion}_{campaign}"],
-            )
-
-    for ion_campaign, graph in graphs_for_plot.items():
-        graph.SetName(f"{name_graph}_{ion_campaign}")
-        graph.GetXaxis().SetTitle(label_xaxis)
-        graph.GetYaxis().SetTitle(label_yaxis)
-        graph.GetXaxis().SetLimits(*limits_xaxis)
-        graph.GetYaxis().SetRangeUser(*limits_yaxis)
-        split = ion_campaign.split("_")
-        ion = split[0]
-        campaign = split[1]
-        set_object_style(
-            obj=graph,
-            color=color_graph[ion][campaign],
-            markerstyle=markerstyle_graph[ion][campaign],
-        )
-
     # configure fit
-    # func_birks = r.TF1("func_birks", BirksLaw(), *range_fit, 3)
+    # func_birks = r.TF1("func_birks", BIRKS_LAW, *range_fit)
     # func_birks.SetParNames("S", "A_0", "Kb")
-    range_fit = config["fit"]["range"]
     func_birks: dict = {}
     for ion, fit_range in range_fit.items():
-        func_birks[ion] = r.TF1(f"func_birks_{ion}", BirksLaw(), *fit_range, 3)
+        func_birks[ion] = r.TF1(f"func_birks_{ion}", BIRKS_LAW, *fit_range)
         func_birks[ion].SetParNames("S", "A_0", "Kb")
-        func_birks[ion].FixParameter(2, 0.126 / 2)
         set_object_style(obj=func_birks[ion], linecolor=color_fit[ion], linewidth=2)
 
     # config of fit result storage
@@ -279,12 +405,20 @@ def main(name_config_file: str) -> None:
         "Xmax",
     ]
 
-    fit_res: dict = {}
+    # Kb fixed to the value of the literature
+    kb: float = 0.126 / 2
+
+    # the fits of the ions take a few points each, they are run in the main
+    # process, a child process per ion costing more than the fit itself
+    results_fit: dict = {
+        ion: fit_birks(*data_ion, kb=kb) for ion, data_ion in data_for_fit.items()
+    }
+
     hfit_res: dict = {}
     my_res: dict = {}
     errors: dict = {}
     for ion, graph in graphs_for_fit.items():
-        fit_res[ion] = graphs_for_fit[ion].Fit(f"func_birks_{ion}", "S")  # , "RS")
+        chi2, ndf, params, unc_params = results_fit[ion]
         hfit_res[ion] = r.TH1D(
             f"hFitRes{graph.GetName()}",
             "",
@@ -294,86 +428,75 @@ def main(name_config_file: str) -> None:
         )
 
         my_res[ion] = [
-            fit_res[ion].Status(),
-            fit_res[ion].Chi2(),
-            fit_res[ion].Ndf(),
-            fit_res[ion].Parameter(0),
-            fit_res[ion].Parameter(1),
-            fit_res[ion].Parameter(2),
+            0,  # a fit that did not converge is fatal
+            chi2,
+            ndf,
+            *params,
             *range_fit[ion],
         ]
         errors[ion] = [
             0,  # no error on fit status
             0,  # no error on chi2
             0,  # no error on ndf
-            fit_res[ion].ParError(0),
-            fit_res[ion].ParError(1),
-            fit_res[ion].ParError(2),
+            *unc_params,
             0,  # no error on xmin
             0,  # no error on xmax
         ]
-        for ilabel, (label, res, error) in enumerate(
-            zip(labels_hfit_res, my_res[ion], errors[ion])
-        ):
-            ibin = ilabel + 1
+        for ibin, label in enumerate(labels_hfit_res, start=1):
             hfit_res[ion].GetXaxis().SetBinLabel(ibin, label)
-            hfit_res[ion].SetBinContent(ibin, res)
-            hfit_res[ion].SetBinError(ibin, error)
+        # contents and errors of all the bins set at once, flow bins included
+        hfit_res[ion].SetContent(np.array([0, *my_res[ion], 0], dtype=np.float64))
+        hfit_res[ion].SetError(np.array([0, *errors[ion], 0], dtype=np.float64))
+        hfit_res[ion].SetEntries(len(labels_hfit_res))
 
     c = r.TCanvas("c", "", 800, 800)
 
-    for i, graph in enumerate(list(graphs_for_plot.values())):
-        if i == 0:
-            graph.Draw("ap")
-            continue
-        graph.Draw("p")
+    # all the graphs drawn at once, sharing the same frame
+    mgraph = r.TMultiGraph()
+    for graph in graphs_for_plot.values():
+        mgraph.Add(graph, "p")
+    mgraph.Draw("a")
+    mgraph.GetXaxis().SetTitle(label_xaxis)
+    mgraph.GetYaxis().SetTitle(label_yaxis)
+    mgraph.GetXaxis().SetLimits(*limits_xaxis)
+    mgraph.SetMinimum(limits_yaxis[0])
+    mgraph.SetMaximum(limits_yaxis[1])
 
     for ion, f_birks in func_birks.items():
-        f_birks.SetParameters(
-            fit_res[ion].Parameter(0),
-            fit_res[ion].Parameter(1),
-            fit_res[ion].Parameter(2),
-        )
+        f_birks.SetParameters(*my_res[ion][3:6])
         set_object_style(obj=f_birks, linecolor=color_fit[ion])
         f_birks.Draw("same")
 
     leg = r.TLegend(padleftmargin + 0.02, 0.75, 0.3, 0.90)
     leg.SetTextSize(0.035)
     leg.SetFillStyle(0)
-    for ion, mydict in config["graph"]["legend"].items():
+    for ion, mydict in legend_graph.items():
         for campaign, label in mydict.items():
-            leg.AddEntry(graphs_for_plot[f"{ion}_{campaign}"], label, "p")
+            leg.AddEntry(graphs_for_plot[(ion, campaign)], label, "p")
     leg.Draw()
 
-    for (ion, xmin), (_, ymax), (_, color) in zip(
-        xmin_tlatex.items(), ymax_tlatex.items(), color_fit.items()
-    ):
-
-        latex_fitpars = r.TLatex()
-        xlatex_fitpars = xmin  # padleftmargin + 0.45
-        ylatex_fitpars_max = ymax  # 0.9
-        latex_fitpars.SetNDC()
-        latex_fitpars.SetTextSize(0.028)
-        latex_fitpars.SetTextAlign(13)  # align at top
-        latex_fitpars.SetTextFont(42)
-        unit = "mV"
-        if "Charge" in label_yaxis:
-            unit = "mV.s"
-        latex_fitpars.DrawLatex(
-            xlatex_fitpars,
-            ylatex_fitpars_max,
-            f"#color[{color}]{{S = {my_res[ion][3]:.3f} #pm {errors[ion][3]:.3f} {unit}.MeV^{{-1}}}}",
-        )
-        latex_fitpars.DrawLatex(
-            xlatex_fitpars,
-            ylatex_fitpars_max - 0.05,
-            f"#color[{color}]{{A_{{0}} = {my_res[ion][4]:.3f} #pm {errors[ion][4]:.3f} MeV}}",
-        )
-        latex_fitpars.DrawLatex(
-            xlatex_fitpars,
-            ylatex_fitpars_max - 0.1,
-            f"#color[{color}]{{K_{{B}} = {my_res[ion][5]:.6f} #pm {errors[ion][5]:.6f} MeV^{{-1}}}}",
-        )
+    latex_fitpars = r.TLatex()
+    latex_fitpars.SetNDC()
+    latex_fitpars.SetTextSize(0.028)
+    latex_fitpars.SetTextAlign(13)  # align at top
+    latex_fitpars.SetTextFont(42)
+    unit: str = "mV.s" if "Charge" in label_yaxis else "mV"
+    # (text, offset from the top) of each line, filled with color, value, error
+    lines_fitpars: list[tuple] = [
+        ("#color[{}]{{S = {:.3f} #pm {:.3f} " + unit + ".MeV^{{-1}}}}", 0.0),
+        ("#color[{}]{{A_{{0}} = {:.3f} #pm {:.3f} MeV}}", 0.05),
+        ("#color[{}]{{K_{{B}} = {:.6f} #pm {:.6f} MeV^{{-1}}}}", 0.1),
+    ]
+    for ion in ions:
+        color = color_fit[ion]
+        xlatex_fitpars = xmin_tlatex[ion]  # padleftmargin + 0.45
+        ylatex_fitpars_max = ymax_tlatex[ion]  # 0.9
+        for ipar, (text, offset) in enumerate(lines_fitpars, start=3):
+            latex_fitpars.DrawLatex(
+                xlatex_fitpars,
+                ylatex_fitpars_max - offset,
+                text.format(color, my_res[ion][ipar], errors[ion][ipar]),
+            )
 
     c.Update()
     c.Draw()
@@ -396,5 +519,11 @@ def main(name_config_file: str) -> None:
 if __name__ == "__main__":
     parser = ArgumentParser(description="Arguments")
     parser.add_argument("name_config_file", metavar="text", default="config.yaml")
+    parser.add_argument(
+        "--cache",
+        metavar="dir",
+        default="",
+        help="cache the remote input files in this directory for the next runs",
+    )
     args = parser.parse_args()
-    main(args.name_config_file)
+    main(args.name_config_file, args.cache)
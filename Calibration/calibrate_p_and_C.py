@@ -7,14 +7,12 @@ author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 import numpy as np
 import ROOT as r
-
-try:
-    from yaml import load, FullLoader
-except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+from numpy.lib.recfunctions import structured_to_unstructured
 
 try:
     from argparse import ArgumentParser
@@ -22,17 +20,20 @@ except ModuleNotFoundError:
     print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    import pandas as pd
+    import uproot
 except ModuleNotFoundError:
-    print("Module 'pandas' is not installed. Please install it to run this script.")
+    print("Module 'uproot' is not installed. Please install it to run this script.")
+
+sys.path.append("../Utils/")
 
 try:
-    import uproot
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'uproot' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
-    sys.path.append("../Utils/")
     from logger import Logger
 except ModuleNotFoundError:
     print(
@@ -40,15 +41,13 @@ except ModuleNotFoundError:
     )
 
 try:
-    sys.path.append("../Utils/")
-    from utils import fill_th1, get_h_config, enforce_list
+    from fit_utils import BIRKS_LAW, fit_birks
 except ModuleNotFoundError:
     print(
-        "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
+        "Module 'fit_utils' is not in the '../Utils/' directory. Add it to run this script."
     )
 
 try:
-    sys.path.append("../Utils/")
     from style_formatter import set_global_style, set_object_style
 except ModuleNotFoundError:
     print(
@@ -56,23 +55,150 @@ except ModuleNotFoundError:
     )
 
 
-# pylint:disable=too-few-public-methods
-class BirksLaw:
+# means and sigmas of the fits of real and simulated data, one row per pair of
+# real and simulated input files, the names being kept as objects so that they
+# are never truncated
+FITRES_DTYPE = np.dtype(
+    [
+        ("campaign", object),
+        ("mean_real", "f8"),
+        ("sigma_real", "f8"),
+        ("mean_simu", "f8"),
+        ("sigma_simu", "f8"),
+    ]
+)
+
+
+def read_fitres(
+    name_infile: str, name_hists: list[str], number_mean_bin: int, number_sigma_bin: int
+) -> dict:
+    """
+    Helper method to read the mean and the sigma stored in the histograms of
+    fit results of an input file, opening the file only once
+
+    Parameters
+    ------------------------------------------------
+    - name_infile: str
+        Name of the input file
+
+    - name_hists: list[str]
+        Names of the histograms of fit results
+
+    - number_mean_bin: int
+        Number of the bin storing the mean
+
+    - number_sigma_bin: int
+        Number of the bin storing the sigma
+
+    Returns
+    ------------------------------------------------
+    - fitres: dict
+        (mean, sigma) read from each histogram, indexed by its name
     """
-    Class to define Birks law for calibration fit
+
+    fitres: dict = {}
+    with uproot.open(name_infile) as infile:
+        for name_hist in name_hists:
+            # single read of all the bins, flow bins included so that the
+            # array is indexed like ROOT bin numbers
+            values: np.ndarray = infile[name_hist].values(flow=True)
+            fitres[name_hist] = (values[number_mean_bin], values[number_sigma_bin])
+
+    return fitres
+
+
+def tabulate_fitres(
+    name_infiles_real: dict,
+    name_infiles_simu: dict,
+    name_hist_fitres_real: str,
+    name_hist_fitres_simu: str,
+    fitres: dict,
+) -> np.ndarray:
     """
+    Helper method to gather the means and the sigmas read from the input
+    files in a single table, one row per pair of real and simulated files
 
-    def __call__(self, x, par):
-        edep = x[0]
-        s = par[0]
-        a0 = par[1]
-        kb = par[2]
+    Parameters
+    ------------------------------------------------
+    - name_infiles_real: dict
+        Real data input files, per campaign
 
-        return (s * edep + a0) / (1 + kb * edep)
+    - name_infiles_simu: dict
+        Simulated data input files, per campaign
+
+    - name_hist_fitres_real: str
+        Name of the histogram of fit results of real data
+
+    - name_hist_fitres_simu: str
+        Name of the histogram of fit results of simulated data
+
+    - fitres: dict
+        (mean, sigma) read from each (file, histogram of fit results)
+
+    Returns
+    ------------------------------------------------
+    - table: np.ndarray
+        Structured array of dtype FITRES_DTYPE
+    """
+
+    n_rows: int = sum(len(name_infiles) for name_infiles in name_infiles_real.values())
+    table: np.ndarray = np.empty(n_rows, dtype=FITRES_DTYPE)
+
+    irow: int = 0
+    for campaign, name_infiles_campaign_real in name_infiles_real.items():
+        name_infiles_campaign_simu = name_infiles_simu[campaign]
+        if len(name_infiles_campaign_real) != len(name_infiles_campaign_simu):
+            Logger(
+                f"'input/real/file/{campaign}' and 'input/simulation/file/{campaign}'"
+                " entries must be of same size!",
+                "FATAL",
+            )
+        for name_infile_real, name_infile_simu in zip(
+            name_infiles_campaign_real, name_infiles_campaign_simu
+        ):
+            table[irow] = (
+                campaign,
+                *fitres[(name_infile_real, name_hist_fitres_real)],
+                *fitres[(name_infile_simu, name_hist_fitres_simu)],
+            )
+            irow += 1
+
+    return table
+
+
+def stage_input(name_infile: str) -> str:
+    """
+    Helper method to copy a remote input file into the local cache directory
+    of ROOT, set with TFile::SetCacheFileDir
+
+    Parameters
+    ------------------------------------------------
+    - name_infile: str
+        Name of the input file
+
+    Returns
+    ------------------------------------------------
+    - name_local_infile: str
+        Name of the local copy of the input file, the input file itself if
+        it is already local
+    """
+
+    if "://" not in name_infile:
+        return name_infile
+
+    # CACHEREAD downloads the file on first use only, the cached copy is
+    # fetched again if its UUID differs from the one of the remote file
+    infile: r.TFile = r.TFile.Open(name_infile, "CACHEREAD")
+    if not infile or infile.IsZombie():
+        Logger(f"Could not open input file '{name_infile}'", "FATAL")
+    name_local_infile: str = infile.GetName()
+    infile.Close()
+
+    return name_local_infile
 
 
 # pylint:disable=too-many-locals
-def main(name_config_file: str) -> None:
+def main(name_config_file: str, dir_cache: str = "") -> None:
     """
     Main function
 
@@ -80,6 +206,9 @@ def main(name_config_file: str) -> None:
     ------------------------------------------------
     - name_config_file: str
         Name of the YAML config file
+
+    - dir_cache: str
+        Directory where the remote input files are cached, no cache if empty
     """
     padleftmargin = 0.12
     set_global_style(
@@ -93,9 +222,7 @@ def main(name_config_file: str) -> None:
     )
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     # handle input
     name_infiles_real: dict = config["input"]["real"]["file"]
@@ -157,30 +284,46 @@ def main(name_config_file: str) -> None:
 
     campaigns = list(name_infiles_real.keys())
 
-    means_real = {}
-    sigmas_real = {}
-    means_simu = {}
-    sigmas_simu = {}
-
-    for campaign, name_infiles_campaign in name_infiles_real.items():
-        means_real[campaign] = []
-        sigmas_real[campaign] = []
-        for name_infile_real in name_infiles_campaign:
-            infile_real: r.TFile = r.TFile.Open(name_infile_real)
-            hist_real: r.TH1 = infile_real.Get(name_hist_fitres_real)
-            means_real[campaign].append(hist_real.GetBinContent(number_mean_bin))
-            sigmas_real[campaign].append(hist_real.GetBinContent(number_sigma_bin))
-            infile_real.Close()
-
-    for campaign, name_infiles_campaign in name_infiles_simu.items():
-        means_simu[campaign] = []
-        sigmas_simu[campaign] = []
-        for name_infile_simu in name_infiles_campaign:
-            infile_simu: r.TFile = r.TFile.Open(name_infile_simu)
-            hist_simu: r.TH1 = infile_simu.Get(name_hist_fitres_simu)
-            means_simu[campaign].append(hist_simu.GetBinContent(number_mean_bin))
-            sigmas_simu[campaign].append(hist_simu.GetBinContent(number_sigma_bin))
-            infile_simu.Close()
+    # gather the histograms of fit results to read per input file, so that a
+    # file shared by the real and the simulated data, or by several ions or
+    # campaigns, is opened only once
+    name_hists_per_file: dict = {}
+    for name_infiles, name_hist in [
+        (name_infiles_real, name_hist_fitres_real),
+        (name_infiles_simu, name_hist_fitres_simu),
+    ]:
+        for name_infiles_campaign in name_infiles.values():
+            for name_infile in name_infiles_campaign:
+                name_hists_per_file.setdefault(name_infile, {})[name_hist] = None
+
+    name_infiles_read: list[str] = list(name_hists_per_file)
+    if dir_cache:
+        r.TFile.SetCacheFileDir(dir_cache)
+        name_infiles_read = [stage_input(name) for name in name_infiles_read]
+
+    # uproot releases the GIL while reading and decompressing, the inputs are
+    # then read concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        fitres_per_file = executor.map(
+            read_fitres,
+            name_infiles_read,
+            [list(name_hists) for name_hists in name_hists_per_file.values()],
+            repeat(number_mean_bin),
+            repeat(number_sigma_bin),
+        )
+        fitres: dict = {
+            (name_infile, name_hist): fitres_hist
+            for name_infile, fitres_file in zip(name_hists_per_file, fitres_per_file)
+            for name_hist, fitres_hist in fitres_file.items()
+        }
+
+    fitres_table: np.ndarray = tabulate_fitres(
+        name_infiles_real,
+        name_infiles_simu,
+        name_hist_fitres_real,
+        name_hist_fitres_simu,
+        fitres,
+    )
 
     # for name_infile_real in name_infiles_real:
     #     infile_real: r.TFile = r.TFile.Open(name_infile_real)
@@ -197,33 +340,30 @@ def main(name_config_file: str) -> None:
     #     sigmas_simu.append(hist_simu.GetBinContent(number_sigma_bin))
     #     infile_simu.Close()
 
+    # (x, y, unc_x, unc_y) of all the points as the rows of a single float64
+    # block, its rows and the columns selected with a mask are contiguous and
+    # handed as is to TGraphErrors
+    points: np.ndarray = np.ascontiguousarray(
+        structured_to_unstructured(
+            fitres_table[["mean_simu", "mean_real", "sigma_simu", "sigma_real"]]
+        ).T,
+        dtype=np.float64,
+    )
+
     # create TGraphErrors for fit
-    x, unc_x = [], []
-    y, unc_y = [], []
-    for campaign in campaigns:
-        x.extend(means_simu[campaign])
-        unc_x.extend(sigmas_simu[campaign])
-        y.extend(means_real[campaign])
-        unc_y.extend(sigmas_real[campaign])
-
-    range_fit = [min(x), max(x)]
-    x = np.array(x)
-    unc_x = np.array(unc_x)
-    y = np.array(y)
-    unc_y = np.array(unc_y)
+    x, y, unc_x, unc_y = points
+
+    range_fit = [x.min(), x.max()]
     graph_for_fit = r.TGraphErrors(len(x), x, y, unc_x, unc_y)
     graph_for_fit.SetName(f"{name_graph}")
-    # create TGraphErrors for plot
-    x, unc_x = {}, {}
-    y, unc_y = {}, {}
+    data_for_fit: tuple = (x, y, unc_x, unc_y)
+    # create TGraphErrors for plot, from the same block of points
     graphs_for_plot = {}
     for campaign in campaigns:
-        x[campaign] = np.array(means_simu[campaign])
-        unc_x[campaign] = np.array(sigmas_simu[campaign])
-        y[campaign] = np.array(means_real[campaign])
-        unc_y[campaign] = np.array(sigmas_real[campaign])
+        mask: np.ndarray = fitres_table["campaign"] == campaign
+        points_campaign: np.ndarray = points[:, mask]
         graphs_for_plot[campaign] = r.TGraphErrors(
-            len(x[campaign]), x[campaign], y[campaign], unc_x[campaign], unc_y[campaign]
+            points_campaign.shape[1], *points_campaign
         )
 
     for campaign, graph in graphs_for_plot.items():
@@ -238,15 +378,9 @@ def main(name_config_file: str) -> None:
             markerstyle=markerstyle_graph[campaign],
         )
 
-    # configure fit
-    # func_birks = r.TF1("func_birks", BirksLaw(), *range_fit, 3)
-    # func_birks.SetParNames("S", "A_0", "Kb")
+    # configure fit, Kb is a free parameter
     # range_fit = config["fit"]["range"]
-    func_birks = r.TF1("func_birks", BirksLaw(), *range_fit, 3)
-    func_birks.SetParNames("S", "A_0", "Kb")
     # kb = 0.126 / 2  # 0.008 / 1.02 / 2
-    # func_birks.FixParameter(2, kb)
-    # set_object_style(obj=func_birks, linecolor=color_fit, linewidth=2)
 
     # config of fit result storage
     labels_hfit_res: list[str] = [
@@ -260,11 +394,10 @@ def main(name_config_file: str) -> None:
         "Xmax",
     ]
 
-    fit_res: dict = {}
     hfit_res: dict = {}
     my_res: dict = {}
     errors: dict = {}
-    fit_res = graph_for_fit.Fit("func_birks", "S")  # , "RS")
+    chi2, ndf, params, unc_params = fit_birks(*data_for_fit)
     hfit_res = r.TH1D(
         f"hFitRes{graph_for_fit.GetName()}",
         "",
@@ -274,37 +407,32 @@ def main(name_config_file: str) -> None:
     )
 
     my_res = [
-        fit_res.Status(),
-        fit_res.Chi2(),
-        fit_res.Ndf(),
-        fit_res.Parameter(0),
-        fit_res.Parameter(1),
-        fit_res.Parameter(2),
+        0,  # a fit that did not converge is fatal
+        chi2,
+        ndf,
+        *params,
         *range_fit,
     ]
     errors = [
         0,  # no error on fit status
         0,  # no error on chi2
         0,  # no error on ndf
-        fit_res.ParError(0),
-        fit_res.ParError(1),
-        fit_res.ParError(2),
+        *unc_params,
         0,  # no error on xmin
         0,  # no error on xmax
     ]
-    for ilabel, (label, res, error) in enumerate(zip(labels_hfit_res, my_res, errors)):
-        ibin = ilabel + 1
+    for ibin, label in enumerate(labels_hfit_res, start=1):
         hfit_res.GetXaxis().SetBinLabel(ibin, label)
-        hfit_res.SetBinContent(ibin, res)
-        hfit_res.SetBinError(ibin, error)
+    # contents and errors of all the bins set at once, flow bins included
+    hfit_res.SetContent(np.array([0, *my_res, 0], dtype=np.float64))
+    hfit_res.SetError(np.array([0, *errors, 0], dtype=np.float64))
+    hfit_res.SetEntries(len(labels_hfit_res))
 
     c = r.TCanvas("c", "", 800, 800)
 
-    func_birks_for_plot = r.TF1("func_birks_for_plot", BirksLaw(), *limits_xaxis, 3)
+    func_birks_for_plot = r.TF1("func_birks_for_plot", BIRKS_LAW, *limits_xaxis)
     func_birks_for_plot.SetParNames("S", "A_0", "Kb")
-    func_birks_for_plot.SetParameters(
-        fit_res.Parameter(0), fit_res.Parameter(1), fit_res.Parameter(2)
-    )
+    func_birks_for_plot.SetParameters(*params)
     func_birks_for_plot.GetXaxis().SetTitle(label_xaxis)
     func_birks_for_plot.GetYaxis().SetTitle(label_yaxis)
     func_birks_for_plot.GetXaxis().SetLimits(*limits_xaxis)
@@ -314,11 +442,11 @@ def main(name_config_file: str) -> None:
     # set_object_style(obj=f_birks, linecolor=color_fit[campaign])
     func_birks_for_plot.Draw()
 
-    for i, graph in enumerate(list(graphs_for_plot.values())):
-        if i == 0:
-            graph.Draw("p")
-            continue
-        graph.Draw("p")
+    # all the graphs drawn at once on the frame of the function
+    mgraph = r.TMultiGraph()
+    for graph in graphs_for_plot.values():
+        mgraph.Add(graph, "p")
+    mgraph.Draw()
 
     leg = r.TLegend(padleftmargin + 0.05, 0.75, 0.3, 0.90)
     leg.SetTextSize(0.035)
@@ -361,7 +489,10 @@ def main(name_config_file: str) -> None:
     # configure output with fit results
     name_outfile: str = config["output"]["file"]
     name_pdf_outfile: str = name_outfile.replace(".root", str()) + ".pdf"
-    outfile: r.TFile = r.TFile(name_outfile, "recreate")
+    # LZ4 compresses much faster than the default ZLIB for a similar factor
+    outfile: r.TFile = r.TFile(
+        name_outfile, "recreate", "", r.ROOT.CompressionSettings(r.ROOT.kLZ4, 4)
+    )
 
     for _, graph in graphs_for_plot.items():
         graph.Write()
@@ -377,5 +508,11 @@ def main(name_config_file: str) -> None:
 if __name__ == "__main__":
     parser = ArgumentParser(description="Arguments")
     parser.add_argument("name_config_file", metavar="text", default="config.yaml")
+    parser.add_argument(
+        "--cache",
+        metavar="dir",
+        default="",
+        help="cache the remote input files in this directory for the next runs",
+    )
     args = parser.parse_args()
-    main(args.name_config_file)
+    main(args.name_config_file, args.cache)
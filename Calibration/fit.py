@@ -7,36 +7,31 @@ author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
 import sys
+from math import sqrt
 
 import numpy as np
 import ROOT as r
 
-try:
-    from yaml import load, FullLoader
-except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
-
 try:
     from argparse import ArgumentParser
 except ModuleNotFoundError:
     print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from numpy import mean as npmean
-    from numpy import std as npstd
-except ModuleNotFoundError:
-    print("Module 'uproot' is not installed. Please install it to run this script.")
-
-
-try:
-    import pandas as pd
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'pandas' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
-    import uproot
+    sys.path.append("../Utils/")
+    from cfg_validate import validate
 except ModuleNotFoundError:
-    print("Module 'uproot' is not installed. Please install it to run this script.")
+    print(
+        "Module 'cfg_validate' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
@@ -48,7 +43,7 @@ except ModuleNotFoundError:
 
 try:
     sys.path.append("../Utils/")
-    from utils import fill_th1, get_h_config, configure_canvas
+    from utils import get_h_config, configure_canvas
 except ModuleNotFoundError:
     print(
         "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
@@ -56,7 +51,13 @@ except ModuleNotFoundError:
 
 try:
     sys.path.append("../Utils/")
-    from fit_utils import lorentzian, plot_fit, LanGaus, langaufun
+    from fit_utils import (
+        get_roofit_eval_options,
+        lorentzian,
+        plot_fit,
+        LanGaus,
+        langaufun,
+    )
 except ModuleNotFoundError:
     print(
         "Module 'fit_utils' is not in the '../Utils/' directory. Add it to run this script."
@@ -107,7 +108,11 @@ def propagate_unc(sigma1: float, sigma2: float, rho12: float) -> float:
         Propagated uncertainty
     """
 
-    return np.sqrt(sigma1**2 + sigma2**2 + 2 * rho12 * sigma1 * sigma2)
+    variance = sigma1 * sigma1 + sigma2 * sigma2 + 2.0 * rho12 * sigma1 * sigma2
+    if isinstance(variance, np.ndarray):
+        return np.sqrt(variance)
+    # math.sqrt avoids the ufunc dispatch of np.sqrt for floats
+    return sqrt(variance)
 
 
 # pylint:disable=too-many-locals,too-many-branches,too-many-statements
@@ -123,9 +128,11 @@ def main(name_config_file: str) -> None:
     padleftmargin = 0.12
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
+    try:
+        validate(config, "fit")
+    except ValueError as err:
+        Logger(str(err), "FATAL")
 
     # handle input
     name_infile = config["input"]["file"]
@@ -137,30 +144,36 @@ def main(name_config_file: str) -> None:
     histogram_cfg = config["histogram_config"]
     histogram_cfg["range"] = ranges_fit
 
-    # safeties
-    if isinstance(name_branches, list) and isinstance(histogram_cfg["name"], list):
-        if len(name_branches) != len(histogram_cfg["name"]):
-            Logger(
-                "'input/branches' and 'histogram_config/name' must be of same size!",
-                "FATAL",
-            )
-
     for i, _ in enumerate(name_branches):
         h_configs.append(get_h_config(histogram_cfg, i))
 
-    # convert input .root file into pandas dataframe
-    df: pd.DataFrame = uproot.open(name_infile)[name_tree].arrays(
-        name_branches, library="pd"
-    )
-
-    hists = []
-    for name, h_config in zip(name_branches, h_configs):
-        hists.append(fill_th1(df[name], h_config))
+    # book the histograms, the moments and the entries inside the fit range
+    # of all the branches, filled in C++ during a single event loop
+    r.EnableImplicitMT()
+    rdf = r.RDataFrame(name_tree, name_infile)
+    hists_booked: list = []
+    moments_booked: dict = {}
+    data_booked: dict = {}
+    for name, h_config, range_fit in zip(name_branches, h_configs, ranges_fit):
+        hists_booked.append(rdf.Histo1D(h_config, name))
+        moments_booked[name] = (rdf.Mean(name), rdf.StdDev(name))
+        data_booked[name] = rdf.Filter(
+            f"{name} >= {range_fit[0]} && {name} <= {range_fit[1]}"
+        ).AsNumpy([name], lazy=True)
+
+    hists: list = []
+    for hist_booked in hists_booked:
+        hist = hist_booked.GetValue()
+        hist.Sumw2()
+        hists.append(hist)
 
     # configure output with fit results
     name_outfile: str = config["output"]["file"]
     name_pdf_outfile: str = name_outfile.replace(".root", str()) + ".pdf"
-    outfile: r.TFile = r.TFile(name_outfile, "recreate")
+    # LZ4 compresses much faster than the default ZLIB for a similar factor
+    outfile: r.TFile = r.TFile(
+        name_outfile, "recreate", "", r.ROOT.CompressionSettings(r.ROOT.kLZ4, 4)
+    )
     for hist in hists:
         hist.Write()
 
@@ -173,6 +186,9 @@ def main(name_config_file: str) -> None:
     energy_beam: str = config["output"]["plot"]["info"]["beam"]["energy"]
     run_number: str = str(config["output"]["plot"]["info"]["run"])
 
+    is_pdf_open: bool = False
+    c = None  # single canvas, cleared and reused for each plot
+
     # add a fitting procedure
     for i, (
         hist,
@@ -224,9 +240,9 @@ def main(name_config_file: str) -> None:
 
         Logger(f"Start fit of {name_branch}\n", "INFO")
 
-        data = df[name_branch].to_numpy()
-        mean = npmean(data)
-        std = npstd(data)
+        data: np.ndarray = data_booked[name_branch].GetValue()[name_branch]
+        mean: float = moments_booked[name_branch][0].GetValue()
+        std: float = moments_booked[name_branch][1].GetValue()
 
         use_my_langaus = False
 
@@ -239,7 +255,9 @@ def main(name_config_file: str) -> None:
 
         frame = x.frame()
 
-        dataset = r.RooDataSet.from_numpy({name_branch: data}, [x])
+        dataset = r.RooDataSet.from_numpy(
+            {name_branch: np.ascontiguousarray(data, dtype=np.float64)}, [x]
+        )
 
         # Construct landau(t,ml,sl)
         if init_par0[0] == "auto":
@@ -272,7 +290,7 @@ def main(name_config_file: str) -> None:
             )
 
         fit_res = model.fitTo(
-            dataset, r.RooFit.NumCPU(1), Save=True
+            dataset, NumCPU=1, Save=True, **get_roofit_eval_options()
         )  # , Range="fit_range"        )
 
         hfit_correlation = fit_res.correlationHist()
@@ -308,7 +326,7 @@ def main(name_config_file: str) -> None:
         if ymax_canvas != "auto":
             ymax = ymax_canvas
         title = f";{config['output']['plot']['label'][i]}; Entries;"
-        c = configure_canvas(f"c_{i}", xmin, ymin, xmax, ymax, title)
+        c = configure_canvas(f"c_{i}", xmin, ymin, xmax, ymax, title, canvas=c)
         c.Update()
         # c.Draw()
         # c = r.TCanvas(f"c_{i}", "My TCanvas", 600, 600)
@@ -352,13 +370,12 @@ def main(name_config_file: str) -> None:
             my_res.append(fit_res.floatParsFinal().find(name_par).getValV())
             errors.append(fit_res.floatParsFinal().find(name_par).getAsymErrorHi())
 
-        for ilabel, (label, res, error) in enumerate(
-            zip(LABELS_HFIT_RES, my_res, errors)
-        ):
-            ibin = ilabel + 1
+        for ibin, label in enumerate(LABELS_HFIT_RES, start=1):
             hfit_res.GetXaxis().SetBinLabel(ibin, label)
-            hfit_res.SetBinContent(ibin, res)
-            hfit_res.SetBinError(ibin, error)
+        # contents and errors of all the bins set at once, flow bins included
+        hfit_res.SetContent(np.array([0, *my_res, 0], dtype=np.float64))
+        hfit_res.SetError(np.array([0, *errors, 0], dtype=np.float64))
+        hfit_res.SetEntries(len(LABELS_HFIT_RES))
 
         hfit_results.append(hfit_res)
 
@@ -444,24 +461,23 @@ def main(name_config_file: str) -> None:
         # c.Draw()
         c.Write()
 
-        if i == IDX_TO_TEST and IDX_TO_TEST is not None:
-            c.Print(name_pdf_outfile)
-            continue
+        # the multi-page pdf is opened once, before its first page
+        if not is_pdf_open:
+            c.Print(f"{name_pdf_outfile}[")
+            is_pdf_open = True
+        c.Print(name_pdf_outfile)
 
-        if len(name_branches) == 1:
-            c.Print(name_pdf_outfile)
-        else:
-            if i == 0:
-                c.Print(f"{name_pdf_outfile}(")
-            elif i == len(name_branches) - 1:
-                c.Print(f"{name_pdf_outfile})")
-            else:
-                c.Print(name_pdf_outfile)
+    if is_pdf_open:
+        c.Print(f"{name_pdf_outfile}]")
 
     # save in output file
+    # one TCollection::Write call, each object keeps its own key so that the
+    # layout of the output file is unchanged
+    fit_objects = r.TList()
     for hfit_res, hfit_correlation in zip(hfit_results, hfit_correlations):
-        hfit_res.Write()
-        hfit_correlation.Write()
+        fit_objects.Add(hfit_res)
+        fit_objects.Add(hfit_correlation)
+    fit_objects.Write()
     outfile.Close()
 
 
@@ -7,36 +7,40 @@ author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
 import sys
+from math import sqrt
+from multiprocessing import get_context
+from os import cpu_count
+from shutil import rmtree
+from tempfile import mkdtemp
 
 import numpy as np
 import ROOT as r
 
-try:
-    from yaml import load, FullLoader
-except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
-
 try:
     from argparse import ArgumentParser
 except ModuleNotFoundError:
     print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from numpy import mean as npmean
-    from numpy import std as npstd
+    import uproot
 except ModuleNotFoundError:
     print("Module 'uproot' is not installed. Please install it to run this script.")
 
-
 try:
-    import pandas as pd
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'pandas' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
-    import uproot
+    sys.path.append("../Utils/")
+    from cfg_validate import validate
 except ModuleNotFoundError:
-    print("Module 'uproot' is not installed. Please install it to run this script.")
+    print(
+        "Module 'cfg_validate' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
@@ -56,7 +60,7 @@ except ModuleNotFoundError:
 
 try:
     sys.path.append("../Utils/")
-    from fit_utils import lorentzian, plot_fit, LanGaus, langaufun
+    from fit_utils import fit_gauss_unbinned, get_roofit_eval_options
 except ModuleNotFoundError:
     print(
         "Module 'fit_utils' is not in the '../Utils/' directory. Add it to run this script."
@@ -64,12 +68,13 @@ except ModuleNotFoundError:
 
 try:
     sys.path.append("../Utils/")
-    from style_formatter import set_global_style, set_object_style
+    from style_formatter import set_global_style
 except ModuleNotFoundError:
     print(
         "Module 'style_formatter' is not in the '../Utils/' directory. Add it to run this script."
     )
 
+STEP_SIZE: str = "100 MB"  # size of the chunks read from the input tree
 IDX_TO_TEST = (
     None  # index of the distribution list to select when testing individual fits
 )
@@ -118,7 +123,274 @@ def propagate_unc(sigma1: float, sigma2: float, rho12: float) -> float:
         Propagated uncertainty
     """
 
-    return np.sqrt(sigma1**2 + sigma2**2 + 2 * rho12 * sigma1 * sigma2)
+    variance = sigma1 * sigma1 + sigma2 * sigma2 + 2.0 * rho12 * sigma1 * sigma2
+    if isinstance(variance, np.ndarray):
+        return np.sqrt(variance)
+    # math.sqrt avoids the ufunc dispatch of np.sqrt for floats
+    return sqrt(variance)
+
+
+# pylint:disable=too-many-locals,too-many-statements
+def fit_branch(args: tuple) -> str:
+    """
+    Helper function to fit the distribution of one branch with a gaussian and
+    to draw the fit result, run in a worker process
+
+    Parameters
+    ------------------------------------------------
+    - args: tuple
+        Index and name of the branch, name of the data, number of bins, fit
+        range, initial parameters, y range and x label of the canvas, plot
+        information, fit backend, data inside the fit range and name of the
+        scratch file
+
+    Returns
+    ------------------------------------------------
+    - name_scratch_file: str
+        Name of the scratch file containing the canvas, the histogram of the
+        fit results and the correlation histogram
+    """
+
+    (
+        i,
+        name_branch,
+        name_data,
+        nbin,
+        range_fit,
+        init_par0,
+        init_par1,
+        init_par2,
+        ymin_canvas,
+        ymax_canvas,
+        label,
+        (exp, campaign, particle_beam, energy_beam, run_number),
+        backend,
+        data,
+        name_scratch_file,
+    ) = args
+    padleftmargin = 0.12
+
+    if "Charge" in name_branch:
+        padrightmargin = 0.09
+    else:
+        padrightmargin = 0.035  # default value
+
+    set_global_style(
+        padleftmargin=padleftmargin,
+        padrightmargin=padrightmargin,
+        padbottommargin=0.12,
+        padtopmargin=0.05,
+        titlesize=0.045,
+        labelsize=0.04,
+        maxdigits=3,
+    )
+
+    Logger(f"Start fit of {name_branch}\n", "INFO")
+
+    x = r.RooRealVar(name_branch, f"x{i}", *range_fit)
+
+    x.setBins(nbin)
+
+    frame = x.frame()
+
+    dataset = r.RooDataSet.from_numpy(
+        {name_branch: np.ascontiguousarray(data, dtype=np.float64)}, [x]
+    )
+
+    # Construct gauss(t,mg,sg)
+    mg = r.RooRealVar(NAME_PARS_GAUSS[0], NAME_PARS_GAUSS[0], *init_par0)
+    sg = r.RooRealVar(NAME_PARS_GAUSS[1], NAME_PARS_GAUSS[1], *init_par1)
+    gauss = r.RooGaussian("gauss", "gauss", x, mg, sg)
+
+    # add norm
+    norm = r.RooRealVar(NAME_PARS_GAUSS[2], NAME_PARS_GAUSS[2], *init_par2)
+
+    model = r.RooAddPdf("model", "model", [gauss], [norm])
+
+    if backend == "scipy":
+        status, params, unc_params, corr = fit_gauss_unbinned(
+            data, range_fit, mg.getVal(), sg.getVal()
+        )
+        # the RooFit model is then only used to draw the fit
+        for par, value in zip([mg, sg, norm], params):
+            par.setVal(value)
+        pars_final: dict = dict(zip(NAME_PARS_GAUSS, zip(params, unc_params)))
+
+        # same layout as RooFitResult::correlationHist
+        n_pars: int = len(NAME_PARS_GAUSS)
+        hfit_correlation = r.TH2D(
+            f"hFitCorrelation{name_data}", "", n_pars, 0, n_pars, n_pars, 0, n_pars
+        )
+        for ipar, name_par in enumerate(NAME_PARS_GAUSS):
+            hfit_correlation.GetXaxis().SetBinLabel(ipar + 1, name_par)
+            hfit_correlation.GetYaxis().SetBinLabel(n_pars - ipar, name_par)
+            for jpar in range(n_pars):
+                hfit_correlation.SetBinContent(
+                    ipar + 1, n_pars - jpar, corr[ipar, jpar]
+                )
+    else:
+        fit_res = model.fitTo(
+            dataset, Save=True, **get_roofit_eval_options()
+        )  # , Range="fit_range"        )
+        status = fit_res.status()
+        pars_final: dict = {
+            name_par: (
+                fit_res.floatParsFinal().find(name_par).getValV(),
+                fit_res.floatParsFinal().find(name_par).getAsymErrorHi(),
+            )
+            for name_par in NAME_PARS_GAUSS
+        }
+
+        hfit_correlation = fit_res.correlationHist()
+        hfit_correlation.SetName(f"hFitCorrelation{name_data}")
+
+    # get most probable value (MPV), the mean of the gaussian
+    x_mpv, s_mpv = pars_final[NAME_PARS_GAUSS[0]]
+
+    ##########
+    # Plot
+    xmin = range_fit[0]
+    xmax = range_fit[1]
+    ymin = 0
+    if ymin_canvas != "auto":
+        ymin = ymin_canvas
+
+    ymax = ymax_canvas  # 'auto' already replaced by the main process
+    title = f";{label}; Entries;"
+    c = configure_canvas(f"c_{i}", xmin, ymin, xmax, ymax, title)
+    c.Update()
+    c.Draw()
+    # c = r.TCanvas(f"c_{i}", "My TCanvas", 600, 600)
+    dataset.plotOn(frame, MarkerStyle=r.kFullCircle)
+    model.plotOn(frame, LineColor=r.kAzure + 4, LineWidth=2, MoveToBack=True)
+    frame.Draw("same")
+    ##########
+
+    # Use fit result
+    hfit_res = r.TH1D(
+        f"hFitRes{name_data}",
+        "",
+        len(LABELS_HFIT_RES_GAUSS),
+        0,
+        len(LABELS_HFIT_RES_GAUSS) - 1,
+    )
+    my_res = [status, frame.chiSquare(), *range_fit, x_mpv, s_mpv]
+
+    errors = [
+        0,  # no error on fit status
+        0,  # no error on chi2
+        0,  # no error on xmin
+        0,  # no error on xmax
+        0,  # no error on x_mpv
+        0,  # no error on s_mpv
+    ]
+
+    for value, error in pars_final.values():
+        my_res.append(value)
+        errors.append(error)
+
+    for ibin, label in enumerate(LABELS_HFIT_RES_GAUSS, start=1):
+        hfit_res.GetXaxis().SetBinLabel(ibin, label)
+    # contents and errors of all the bins set at once, flow bins included
+    hfit_res.SetContent(np.array([0, *my_res, 0], dtype=np.float64))
+    hfit_res.SetError(np.array([0, *errors, 0], dtype=np.float64))
+    hfit_res.SetEntries(len(LABELS_HFIT_RES_GAUSS))
+
+    # add a legend
+    if "Charge" in name_branch:
+        leg = r.TLegend(padleftmargin + 0.45, 0.8, 0.87, 0.9)
+    elif "Amplitude" in name_branch:
+        leg = r.TLegend(padleftmargin + 0.53, 0.8, 0.87, 0.9)
+    else:
+        leg = r.TLegend(padleftmargin + 0.62, 0.8, 0.95, 0.9)
+    leg.SetTextSize(0.035)
+    leg.SetFillStyle(0)
+    leg.AddEntry(dataset, "Data", "p")
+    leg.AddEntry(model, "Gauss", "l")
+
+    leg.Draw()
+
+    # add information in TLatex
+    latex_clinm = r.TLatex()
+    xlatex_clinm = padleftmargin + 0.03  # 0.18
+    ylatex_clinm = 0.92
+    latex_clinm.SetNDC()
+    latex_clinm.SetTextSize(0.04)
+    latex_clinm.SetTextAlign(13)  # align at top
+    latex_clinm.SetTextFont(42)
+    latex_clinm.DrawLatex(xlatex_clinm, ylatex_clinm, exp)
+
+    latex_info = r.TLatex()
+    xlatex_info = padleftmargin + 0.03
+    ylatex_info_max = 0.92 - 0.06
+    latex_info.SetNDC()
+    latex_info.SetTextSize(0.03)
+    latex_info.SetTextAlign(13)  # align at top
+    latex_info.SetTextFont(42)
+    latex_info.DrawLatex(xlatex_info, ylatex_info_max, campaign)
+    latex_info.DrawLatex(
+        xlatex_info, ylatex_info_max - 0.05, f"{particle_beam} @ {energy_beam}"
+    )
+    latex_info.DrawLatex(xlatex_info, ylatex_info_max - 0.1, f"Run {run_number}")
+
+    latex_fitpars = r.TLatex()
+    xlatex_fitpars = (
+        padleftmargin + 0.55 if "Amplitude" in name_branch else padleftmargin + 0.5
+    )
+    if "EnergyDeposit" in name_branch:
+        xlatex_fitpars = padleftmargin + 0.56
+    ylatex_fitpars_max = 0.75
+    latex_fitpars.SetNDC()
+    latex_fitpars.SetTextSize(0.03)
+    latex_fitpars.SetTextAlign(13)  # align at top
+    latex_fitpars.SetTextFont(42)
+    latex_fitpars.DrawLatex(
+        xlatex_fitpars, ylatex_fitpars_max, f"#chi^{{2}} / ndf = {my_res[1]:.2f}"
+    )
+    # latex_fitpars.DrawLatex(
+    #     xlatex_fitpars,
+    #     ylatex_fitpars_max - 0.05,
+    #     f"m_{{l}} = {my_res[5]:.3f} #pm {errors[5]:.3f}",
+    # )
+    # latex_fitpars.DrawLatex(
+    #     xlatex_fitpars,
+    #     ylatex_fitpars_max - 0.05,
+    #     f"#sigma_{{l}} = {my_res[8]:.3f} #pm {errors[8]:.3f}",
+    # )
+    # # latex_fitpars.DrawLatex(
+    # #     xlatex_fitpars,
+    # #     ylatex_fitpars_max - 0.15,
+    # #     f"m_{{g}} = {my_res[7]:.3f} #pm {errors[7]:.3f}",
+    # # )
+    # latex_fitpars.DrawLatex(
+    #     xlatex_fitpars,
+    #     ylatex_fitpars_max - 0.10,
+    #     f"#sigma_{{g}} = {my_res[10]:.3f} #pm {errors[10]:.3f}",
+    # )
+    # latex_fitpars.DrawLatex(
+    #     xlatex_fitpars,
+    #     ylatex_fitpars_max - 0.15,
+    #     f"#rho_{{ #sigma_{{l}} #sigma_{{ g }} }} = {my_res[6]:.3f}",
+    # )
+    latex_fitpars.DrawLatex(
+        xlatex_fitpars,
+        ylatex_fitpars_max - 0.05,
+        f"MPV = {my_res[4]:.4f} #pm {my_res[5]:.4f}",
+    )
+
+    c.Update()
+    c.Draw()
+
+    # the objects are written in a scratch file, read back by the main process
+    scratch_file: r.TFile = r.TFile(
+        name_scratch_file, "recreate", "", r.ROOT.CompressionSettings(r.ROOT.kLZ4, 1)
+    )
+    c.Write()
+    hfit_res.Write()
+    hfit_correlation.Write()
+    scratch_file.Close()
+
+    return name_scratch_file
 
 
 # pylint:disable=too-many-locals,too-many-branches,too-many-statements
@@ -131,12 +403,12 @@ def main(name_config_file: str) -> None:
     - name_config_file: str
         Name of the YAML config file
     """
-    padleftmargin = 0.12
-
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
+    try:
+        validate(config, "fit")
+    except ValueError as err:
+        Logger(str(err), "FATAL")
 
     # handle input
     name_infile = config["input"]["file"]
@@ -148,281 +420,173 @@ def main(name_config_file: str) -> None:
     histogram_cfg = config["histogram_config"]
     histogram_cfg["range"] = ranges_fit
 
-    # safeties
-    if isinstance(name_branches, list) and isinstance(histogram_cfg["name"], list):
-        if len(name_branches) != len(histogram_cfg["name"]):
-            Logger(
-                "'input/branches' and 'histogram_config/name' must be of same size!",
-                "FATAL",
-            )
-
     for i, _ in enumerate(name_branches):
         h_configs.append(get_h_config(histogram_cfg, i))
 
-    # convert input .root file into pandas dataframe
-    df: pd.DataFrame = uproot.open(name_infile)[name_tree].arrays(
-        name_branches, library="pd"
-    )
-
-    hists = []
-    for name, h_config in zip(name_branches, h_configs):
-        hists.append(fill_th1(df[name], h_config))
-
-    # configure output with fit results
-    name_outfile: str = config["output"]["file"]
-    name_pdf_outfile: str = name_outfile.replace(".root", str()) + ".pdf"
-    outfile: r.TFile = r.TFile(name_outfile, "recreate")
-    for hist in hists:
-        hist.Write()
-
-    hfit_results = []
-    hfit_correlations = []
+    # stream the branches of the input .root file chunk by chunk, only the
+    # entries inside the fit range are kept for the unbinned fits
+    # the histograms are created before reading, so that they exist even if
+    # the input tree is empty
+    hists: list[r.TH1D] = []
+    for h_config in h_configs:
+        hist: r.TH1D = r.TH1D(*h_config)
+        hist.Sumw2()
+        hist.SetDirectory(0)
+        hists.append(hist)
+    data_in_range: dict = {name: [] for name in name_branches}
+    # the branches are flat, read them straight as a dict of numpy arrays
+    decompression_executor = uproot.ThreadPoolExecutor(4)
+    interpretation_executor = uproot.ThreadPoolExecutor(4)
+    with uproot.open(f"{name_infile}:{name_tree}") as tree:
+        for arrays in tree.iterate(
+            filter_name=name_branches,
+            step_size=STEP_SIZE,
+            library="np",
+            how=dict,
+            decompression_executor=decompression_executor,
+            interpretation_executor=interpretation_executor,
+        ):
+            for name, h_config, range_fit, hist in zip(
+                name_branches, h_configs, ranges_fit, hists
+            ):
+                arr: np.ndarray = arrays[name]
+                fill_th1(arr, h_config, hist)
+                data_in_range[name].append(
+                    arr[(arr >= range_fit[0]) & (arr <= range_fit[1])]
+                )
+    # no reading thread is left running when the fit processes are started
+    decompression_executor.shutdown()
+    interpretation_executor.shutdown()
 
     exp: str = config["output"]["plot"]["info"]["exp"]
     campaign: str = config["output"]["plot"]["info"]["campaign"]
     particle_beam: str = config["output"]["plot"]["info"]["beam"]["particle"]
     energy_beam: str = config["output"]["plot"]["info"]["beam"]["energy"]
     run_number: str = str(config["output"]["plot"]["info"]["run"])
+    info_plot: tuple = (exp, campaign, particle_beam, energy_beam, run_number)
+
+    # 'roofit' (default) or 'scipy', a direct minimisation of the likelihood
+    backend: str = config["fit"].get("backend", "roofit")
+
+    # the fits of the branches are independent, run them in parallel
+    dir_scratch: str = mkdtemp()
+    # the scratch directory is removed even if a fit or the reading fails
+    try:
+        args_fit: list[tuple] = []
+        names_data: list[str] = []
+        for i, (
+            hist,
+            name_branch,
+            name_data,
+            nbin,
+            range_fit,
+            init_par0,
+            init_par1,
+            init_par2,
+            ymin_canvas,
+            ymax_canvas,
+            label,
+        ) in enumerate(
+            zip(
+                hists,
+                name_branches,
+                histogram_cfg["name"],
+                histogram_cfg["nbin"],
+                ranges_fit,
+                init_pars_fit[NAME_PARS_GAUSS[0]],
+                init_pars_fit[NAME_PARS_GAUSS[1]],
+                init_pars_fit[NAME_PARS_GAUSS[2]],
+                config["output"]["plot"]["ymin"],
+                config["output"]["plot"]["ymax"],
+                config["output"]["plot"]["label"],
+            )
+        ):
 
-    # add a fitting procedure
-    for i, (
-        hist,
-        name_branch,
-        name_data,
-        nbin,
-        range_fit,
-        init_par0,
-        init_par1,
-        init_par2,
-        ymin_canvas,
-        ymax_canvas,
-    ) in enumerate(
-        zip(
-            hists,
-            name_branches,
-            histogram_cfg["name"],
-            histogram_cfg["nbin"],
-            ranges_fit,
-            init_pars_fit[NAME_PARS_GAUSS[0]],
-            init_pars_fit[NAME_PARS_GAUSS[1]],
-            init_pars_fit[NAME_PARS_GAUSS[2]],
-            config["output"]["plot"]["ymin"],
-            config["output"]["plot"]["ymax"],
-        )
-    ):
-
-        if i != IDX_TO_TEST and IDX_TO_TEST is not None:
-            continue
-
-        if "Charge" in name_branch:
-            padrightmargin = 0.09
+            if i != IDX_TO_TEST and IDX_TO_TEST is not None:
+                continue
+
+            if ymax_canvas == "auto":
+                ymax_canvas = 1.05 * hist.GetMaximum()
+
+            args_fit.append(
+                (
+                    i,
+                    name_branch,
+                    name_data,
+                    nbin,
+                    range_fit,
+                    init_par0,
+                    init_par1,
+                    init_par2,
+                    ymin_canvas,
+                    ymax_canvas,
+                    label,
+                    info_plot,
+                    backend,
+                    np.concatenate(data_in_range[name_branch]),
+                    f"{dir_scratch}/fit_{i}.root",
+                )
+            )
+            names_data.append(name_data)
+
+        # 'spawn', so that the fit processes start from a clean ROOT state instead
+        # of a copy of the main process
+        names_scratch_files: list[str] = []
+        if len(args_fit) > 0:
+            n_processes: int = max(1, min(len(args_fit), cpu_count() or 1))
+            with get_context("spawn").Pool(n_processes) as pool:
+                names_scratch_files = pool.map(fit_branch, args_fit)
         else:
-            padrightmargin = 0.035  # default value
-
-        set_global_style(
-            padleftmargin=padleftmargin,
-            padrightmargin=padrightmargin,
-            padbottommargin=0.12,
-            padtopmargin=0.05,
-            titlesize=0.045,
-            labelsize=0.04,
-            maxdigits=3,
+            Logger("No distribution selected, no fit is performed", "WARNING")
+
+        # configure output with fit results
+        name_outfile: str = config["output"]["file"]
+        name_pdf_outfile: str = name_outfile.replace(".root", str()) + ".pdf"
+        # ZSTD compresses much faster than the default ZLIB for a similar factor
+        outfile: r.TFile = r.TFile(
+            name_outfile, "recreate", "", r.ROOT.CompressionSettings(r.ROOT.kZSTD, 5)
         )
+        for hist in hists:
+            hist.Write()
 
-        Logger(f"Start fit of {name_branch}\n", "INFO")
-
-        data = df[name_branch].to_numpy()
-
-        x = r.RooRealVar(name_branch, f"x{i}", *range_fit)
-
-        x.setBins(nbin)
-
-        frame = x.frame()
-
-        dataset = r.RooDataSet.from_numpy({name_branch: data}, [x])
-
-        # Construct gauss(t,mg,sg)
-        mg = r.RooRealVar(NAME_PARS_GAUSS[0], NAME_PARS_GAUSS[0], *init_par0)
-        sg = r.RooRealVar(NAME_PARS_GAUSS[1], NAME_PARS_GAUSS[1], *init_par1)
-        gauss = r.RooGaussian("gauss", "gauss", x, mg, sg)
-
-        # add norm
-        norm = r.RooRealVar(NAME_PARS_GAUSS[2], NAME_PARS_GAUSS[2], *init_par2)
-
-        model = r.RooAddPdf("model", "model", [gauss], [norm])
-
-        fit_res = model.fitTo(
-            dataset, r.RooFit.NumCPU(10), Save=True
-        )  # , Range="fit_range"        )
-
-        hfit_correlation = fit_res.correlationHist()
-        hfit_correlation.SetName(f"hFitCorrelation{name_data}")
-        hfit_correlations.append(hfit_correlation)
-
-        func_model = model.asTF(r.RooArgList(x))
-        # get most probable value (MPV)
-        x_mpv: float = func_model.GetMaximumX()
-        # compute uncertainty on MPV by doing some weighted sum in quadrature
-        s_mpv = fit_res.floatParsFinal().find("mu_gauss").getAsymErrorHi()
-
-        ##########
-        # Plot
-        xmin = range_fit[0]
-        xmax = range_fit[1]
-        ymin = 0
-        if ymin_canvas != "auto":
-            ymin = ymin_canvas
-
-        ymax = 1.05 * hist.GetMaximum()
-        if ymax_canvas != "auto":
-            ymax = ymax_canvas
-        title = f";{config['output']['plot']['label'][i]}; Entries;"
-        c = configure_canvas(f"c_{i}", xmin, ymin, xmax, ymax, title)
-        c.Update()
-        c.Draw()
-        # c = r.TCanvas(f"c_{i}", "My TCanvas", 600, 600)
-        dataset.plotOn(frame, MarkerStyle=r.kFullCircle)
-        model.plotOn(frame, LineColor=r.kAzure + 4, LineWidth=2, MoveToBack=True)
-        frame.Draw("same")
-        ##########
-
-        # Use fit result
-        hfit_res = r.TH1D(
-            f"hFitRes{name_data}",
-            "",
-            len(LABELS_HFIT_RES_GAUSS),
-            0,
-            len(LABELS_HFIT_RES_GAUSS) - 1,
-        )
-        my_res = [fit_res.status(), frame.chiSquare(), *range_fit, x_mpv, s_mpv]
-
-        errors = [
-            0,  # no error on fit status
-            0,  # no error on chi2
-            0,  # no error on xmin
-            0,  # no error on xmax
-            0,  # no error on x_mpv
-            0,  # no error on s_mpv
-        ]
-
-        for name_par in NAME_PARS_GAUSS:
-            my_res.append(fit_res.floatParsFinal().find(name_par).getValV())
-            errors.append(fit_res.floatParsFinal().find(name_par).getAsymErrorHi())
-
-        for ilabel, (label, res, error) in enumerate(
-            zip(LABELS_HFIT_RES_GAUSS, my_res, errors)
+        hfit_results = []
+        hfit_correlations = []
+        for icanvas, (args, name_data, name_scratch_file) in enumerate(
+            zip(args_fit, names_data, names_scratch_files)
         ):
-            ibin = ilabel + 1
-            hfit_res.GetXaxis().SetBinLabel(ibin, label)
-            hfit_res.SetBinContent(ibin, res)
-            hfit_res.SetBinError(ibin, error)
-
-        hfit_results.append(hfit_res)
-
-        # add a legend
-        if "Charge" in name_branch:
-            leg = r.TLegend(padleftmargin + 0.45, 0.8, 0.87, 0.9)
-        elif "Amplitude" in name_branch:
-            leg = r.TLegend(padleftmargin + 0.53, 0.8, 0.87, 0.9)
-        else:
-            leg = r.TLegend(padleftmargin + 0.62, 0.8, 0.95, 0.9)
-        leg.SetTextSize(0.035)
-        leg.SetFillStyle(0)
-        leg.AddEntry(dataset, "Data", "p")
-        leg.AddEntry(model, "Gauss", "l")
-
-        leg.Draw()
-
-        # add information in TLatex
-        latex_clinm = r.TLatex()
-        xlatex_clinm = padleftmargin + 0.03  # 0.18
-        ylatex_clinm = 0.92
-        latex_clinm.SetNDC()
-        latex_clinm.SetTextSize(0.04)
-        latex_clinm.SetTextAlign(13)  # align at top
-        latex_clinm.SetTextFont(42)
-        latex_clinm.DrawLatex(xlatex_clinm, ylatex_clinm, exp)
-
-        latex_info = r.TLatex()
-        xlatex_info = padleftmargin + 0.03
-        ylatex_info_max = 0.92 - 0.06
-        latex_info.SetNDC()
-        latex_info.SetTextSize(0.03)
-        latex_info.SetTextAlign(13)  # align at top
-        latex_info.SetTextFont(42)
-        latex_info.DrawLatex(xlatex_info, ylatex_info_max, campaign)
-        latex_info.DrawLatex(
-            xlatex_info, ylatex_info_max - 0.05, f"{particle_beam} @ {energy_beam}"
-        )
-        latex_info.DrawLatex(xlatex_info, ylatex_info_max - 0.1, f"Run {run_number}")
-
-        latex_fitpars = r.TLatex()
-        xlatex_fitpars = (
-            padleftmargin + 0.55 if "Amplitude" in name_branch else padleftmargin + 0.5
-        )
-        if "EnergyDeposit" in name_branch:
-            xlatex_fitpars = padleftmargin + 0.56
-        ylatex_fitpars_max = 0.75
-        latex_fitpars.SetNDC()
-        latex_fitpars.SetTextSize(0.03)
-        latex_fitpars.SetTextAlign(13)  # align at top
-        latex_fitpars.SetTextFont(42)
-        latex_fitpars.DrawLatex(
-            xlatex_fitpars, ylatex_fitpars_max, f"#chi^{{2}} / ndf = {my_res[1]:.2f}"
-        )
-        # latex_fitpars.DrawLatex(
-        #     xlatex_fitpars,
-        #     ylatex_fitpars_max - 0.05,
-        #     f"m_{{l}} = {my_res[5]:.3f} #pm {errors[5]:.3f}",
-        # )
-        # latex_fitpars.DrawLatex(
-        #     xlatex_fitpars,
-        #     ylatex_fitpars_max - 0.05,
-        #     f"#sigma_{{l}} = {my_res[8]:.3f} #pm {errors[8]:.3f}",
-        # )
-        # # latex_fitpars.DrawLatex(
-        # #     xlatex_fitpars,
-        # #     ylatex_fitpars_max - 0.15,
-        # #     f"m_{{g}} = {my_res[7]:.3f} #pm {errors[7]:.3f}",
-        # # )
-        # latex_fitpars.DrawLatex(
-        #     xlatex_fitpars,
-        #     ylatex_fitpars_max - 0.10,
-        #     f"#sigma_{{g}} = {my_res[10]:.3f} #pm {errors[10]:.3f}",
-        # )
-        # latex_fitpars.DrawLatex(
-        #     xlatex_fitpars,
-        #     ylatex_fitpars_max - 0.15,
-        #     f"#rho_{{ #sigma_{{l}} #sigma_{{ g }} }} = {my_res[6]:.3f}",
-        # )
-        latex_fitpars.DrawLatex(
-            xlatex_fitpars,
-            ylatex_fitpars_max - 0.05,
-            f"MPV = {my_res[4]:.4f} #pm {my_res[5]:.4f}",
-        )
-
-        c.Update()
-        c.Draw()
-        c.Write()
-
-        if i == IDX_TO_TEST and IDX_TO_TEST is not None:
+            scratch_file: r.TFile = r.TFile(name_scratch_file)
+            c = scratch_file.Get(f"c_{args[0]}")
+            hfit_res = scratch_file.Get(f"hFitRes{name_data}")
+            hfit_res.SetDirectory(0)
+            hfit_results.append(hfit_res)
+            hfit_correlation = scratch_file.Get(f"hFitCorrelation{name_data}")
+            hfit_correlation.SetDirectory(0)
+            hfit_correlations.append(hfit_correlation)
+
+            outfile.cd()
+            c.Write()
+
+            c.Draw()
+            # the multi-page pdf is opened once, before its first page
+            if icanvas == 0:
+                c.Print(f"{name_pdf_outfile}[")
             c.Print(name_pdf_outfile)
-            continue
-
-        if len(name_branches) == 1:
-            c.Print(name_pdf_outfile)
-        else:
-            if i == 0:
-                c.Print(f"{name_pdf_outfile}(")
-            elif i == len(name_branches) - 1:
-                c.Print(f"{name_pdf_outfile})")
-            else:
-                c.Print(name_pdf_outfile)
+            # and closed after its last page
+            if icanvas == len(args_fit) - 1:
+                c.Print(f"{name_pdf_outfile}]")
+            scratch_file.Close()
+    finally:
+        rmtree(dir_scratch)
 
     # save in output file
+    outfile.cd()
+    # one TCollection::Write call, each object keeps its own key so that the
+    # layout of the output file is unchanged
+    fit_objects = r.TList()
     for hfit_res, hfit_correlation in zip(hfit_results, hfit_correlations):
-        hfit_res.Write()
-        hfit_correlation.Write()
+        fit_objects.Add(hfit_res)
+        fit_objects.Add(hfit_correlation)
+    fit_objects.Write()
     outfile.Close()
 
 
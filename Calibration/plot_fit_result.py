@@ -10,23 +10,44 @@ import sys
 import ROOT as r
 
 try:
-    from yaml import load, FullLoader
+    from argparse import ArgumentParser
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from argparse import ArgumentParser
+    import numpy as np
 except ModuleNotFoundError:
-    print("Module 'argparse' is not installed. Please install it to run this script.")
+    print("Module 'numpy' is not installed. Please install it to run this script.")
+
+try:
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
+except ModuleNotFoundError:
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
-    from utils import configure_canvas, enforce_list
+    from utils import (
+        configure_canvas,
+        enforce_list,
+        th1_errors_to_ndarray,
+        th1_to_ndarray,
+    )
 except ModuleNotFoundError:
     print(
         "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
     )
 
+try:
+    sys.path.append("../Utils/")
+    from cfg_validate import validate
+except ModuleNotFoundError:
+    print(
+        "Module 'cfg_validate' is not in the '../Utils/' directory. Add it to run this script."
+    )
+
 try:
     sys.path.append("../Utils/")
     from logger import Logger
@@ -52,9 +73,6 @@ except ModuleNotFoundError:
     )
 
 
-POSSIBLE_FIT_FUNCS = ["gaus", "lorentz", "crystalball"]
-
-
 # pylint:disable=too-many-statements, too-many-locals
 def main(name_config_file: str) -> None:
     """
@@ -69,9 +87,11 @@ def main(name_config_file: str) -> None:
     padleftmargin = 0.12
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
+    try:
+        validate(config, "plot_fit")
+    except ValueError as err:
+        Logger(str(err), "FATAL")
 
     name_infile: str = config["input"]["file"]
     data: list[str] = enforce_list(config["input"]["data"])
@@ -80,17 +100,6 @@ def main(name_config_file: str) -> None:
     name_outfile: list[str] = enforce_list(config["output"]["file"])
     extension: list[str] = enforce_list(config["output"]["extension"])
 
-    # safety
-    if not len(data) == len(label) == len(name_outfile):
-        Logger(
-            "'input/data', 'plot/label' and 'output/file' must be of same size!",
-            "FATAL",
-        )
-
-    for func_fit in funcs_fit:
-        if func_fit not in POSSIBLE_FIT_FUNCS:
-            Logger("The 'fit/func' options must be 'gaus' or 'lorentz!", "FATAL")
-
     exp: str = config["plot"]["info"]["exp"]
     campaign: str = config["plot"]["info"]["campaign"]
     particle_beam: str = config["plot"]["info"]["beam"]["particle"]
@@ -98,30 +107,35 @@ def main(name_config_file: str) -> None:
     run_number: str = str(config["plot"]["info"]["run"])
 
     infile: r.TFile = r.TFile.Open(name_infile)
+    c = None  # single canvas, cleared and reused for each plot
+
+    # the style only differs by the right margin from one plot to the other,
+    # it is then set once and only the right margin is changed in the loop
+    padrightmargin = 0.035  # default value
+    set_global_style(
+        padleftmargin=padleftmargin,
+        padrightmargin=padrightmargin,
+        padbottommargin=0.12,
+        padtopmargin=0.05,
+        titlesize=0.045,
+        labelsize=0.04,
+        maxdigits=3,
+    )
 
     for i, (dat, lab, func_fit, name_ofile) in enumerate(
         zip(data, label, funcs_fit, name_outfile)
     ):
 
-        if "Charge" in dat:
-            padrightmargin = 0.09
-        else:
-            padrightmargin = 0.035  # default value
-        set_global_style(
-            padleftmargin=padleftmargin,
-            padrightmargin=padrightmargin,
-            padbottommargin=0.12,
-            padtopmargin=0.05,
-            titlesize=0.045,
-            labelsize=0.04,
-            maxdigits=3,
-        )
+        # larger right margin for the charge
+        r.gStyle.SetPadRightMargin(0.09 if "Charge" in dat else padrightmargin)
 
         h_data: r.TH1F = infile.Get(dat)
         h_fitres: r.TH1F = infile.Get(f"hFitRes{dat}")
 
-        chi2 = h_fitres.GetBinContent(2)
-        ndf = h_fitres.GetBinContent(3)
+        # read all the fit results at once rather than bin per bin
+        fitres: np.ndarray = th1_to_ndarray(h_fitres)
+        unc_fitres: np.ndarray = th1_errors_to_ndarray(h_fitres)
+        chi2, ndf, xmin, xmax = fitres[2:6].tolist()
         chi2_ndf = float(chi2) / ndf
 
         eq_func: str = str()
@@ -136,20 +150,16 @@ def main(name_config_file: str) -> None:
             eq_func = "crystalball"
             npars = 5
 
-        pars, unc_pars = [], []
-        for ibin in range(6, 6 + npars):
-            pars.append(h_fitres.GetBinContent(ibin))
-            unc_pars.append(h_fitres.GetBinError(ibin))
+        pars: list[float] = fitres[6 : 6 + npars].tolist()
+        unc_pars: list[float] = unc_fitres[6 : 6 + npars].tolist()
 
-        xmin = h_fitres.GetBinContent(4)
-        xmax = h_fitres.GetBinContent(5)
         func: r.TF1 = r.TF1("func", eq_func, xmin, xmax)
         func.SetParameters(*pars)
 
         ymin = h_data.GetMinimum()
         ymax = 1.05 * max(func.GetMaximum(), h_data.GetMaximum())
         title = f";{lab}; Entries;"
-        c = configure_canvas(f"c{i}", xmin, ymin, xmax, ymax, title)
+        c = configure_canvas(f"c{i}", xmin, ymin, xmax, ymax, title, canvas=c)
 
         set_object_style(h_data, color=r.kBlack, linewidth=2)
         set_object_style(func, color=r.kAzure + 2, linewidth=2)
@@ -223,6 +233,7 @@ def main(name_config_file: str) -> None:
             c.SaveAs(name_ofile + "." + ext)
 
     infile.Close()
+    r.gStyle.SetPadRightMargin(padrightmargin)  # back to the global style
 
 
 if __name__ == "__main__":
@@ -6,27 +6,38 @@ note: This script requires to be connected to IPHC server
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
-from os import system, makedirs
-from os.path import isdir
+from os import makedirs
+from shlex import quote
 
 import sys
 
 try:
-    from yaml import load, FullLoader
+    from argparse import ArgumentParser
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from argparse import ArgumentParser
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'argparse' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
-    from utils import enforce_trailing_slash
+    from format_utils import enforce_trailing_slash
 except ModuleNotFoundError:
     print(
-        "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
+        "Module 'format_utils' is not in the '../Utils/' directory. Add it to run this script."
+    )
+
+try:
+    sys.path.append("../Utils/")
+    from command_utils import format_command, move_files, run_command
+except ModuleNotFoundError:
+    print(
+        "Module 'command_utils' is not in the '../Utils/' directory. Add it to run this script."
     )
 
 try:
@@ -38,6 +49,31 @@ except ModuleNotFoundError:
     )
 
 POSSIBLE_TYPE_OF_CONTENT: list[str] = ["directory", "file"]
+POSSIBLE_TRANSFER_MODES: list[str] = ["scp", "tar"]
+
+
+def quote_remote_path(path: str) -> str:
+    """
+    Helper function to quote a path for the remote shell, a leading '~/'
+    being kept unquoted so that the remote shell still expands it
+
+    Parameters
+    ------------------------------------------------
+    - path: str
+        Path on the server
+
+    Returns
+    ------------------------------------------------
+    - :str
+        Path that can be given to the remote shell
+    """
+
+    if path == "~":
+        return path
+    if path.startswith("~/"):
+        return "~/" + quote(path[2:]) if len(path) > 2 else path
+
+    return quote(path)
 
 
 def get_address_server(username: str, name_server: str, use_ssh_cm: bool) -> str:
@@ -124,9 +160,7 @@ def main(name_config_file: str) -> None:
     Logger("This script requires to be connected to IPHC server!", "WARNING")
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     # SSH Control Master configuration
     cfg_ssh_cm: dict = config["ssh_control_master"]
@@ -140,6 +174,7 @@ def main(name_config_file: str) -> None:
     content = config["remote"]["content"]
     content_renaming = cfg_local["content_renaming"]
     use_ssh_cm: bool = cfg_remote["use_ssh_control_master"]
+    transfer_mode: str = cfg_remote.get("transfer_mode", "scp")
 
     # safeties
     if content_renaming is not None:
@@ -155,6 +190,10 @@ def main(name_config_file: str) -> None:
         log = f"The type_of_content {type_of_content} is not among the possible values:"
         log += " 'directory' or 'file'."
         Logger(log, "FATAL")
+    if transfer_mode not in POSSIBLE_TRANSFER_MODES:
+        log = f"The transfer_mode {transfer_mode} is not among the possible values:"
+        log += " 'scp' or 'tar'."
+        Logger(log, "FATAL")
 
     # retrieve the rest of the configuration
     username: str = config["remote"]["username"]
@@ -163,49 +202,84 @@ def main(name_config_file: str) -> None:
     dir_local: str = enforce_trailing_slash(cfg_local["dir"]["name"])
 
     if cfg_local["dir"]["mkdir"]:
-        if isdir(dir_local):
-            Logger(f"Local directory {dir_local} already exists.", "INFO")
-        else:
-            Logger(f"Make local directory {dir_local}.", "INFO")
+        try:
             makedirs(dir_local)
+            Logger(f"Make local directory {dir_local}.", "INFO")
+        except FileExistsError:
+            Logger(f"Local directory {dir_local} already exists.", "INFO")
 
     # enforce list type
     if not isinstance(content, list):
         content = [content]
 
-    # first, create the scp command to copy files from remote
-    cmd_copy = "scp "
-
-    if type_of_content == "directory":
-        cmd_copy += "-r "
-
-    for entry in content:
-        cmd_copy += f"{address_server}:{entry} "
-
-    cmd_copy += dir_local
-    cmd_total = cmd_copy
+    # drop the duplicated entries, so that each one is transferred only once
+    if isinstance(content_renaming, list):
+        entries: list[tuple] = list(dict.fromkeys(zip(content, content_renaming)))
+        content = [entry for entry, _ in entries]
+        content_renaming = [new_name for _, new_name in entries]
+    else:
+        content = list(dict.fromkeys(content))
+
+    # first, create the command(s) to copy files from remote, piped if several
+    if transfer_mode == "tar" and len(content) > 1:
+        # stream all the content through a single tar archive, instead of
+        # one scp transfer per file, each entry being archived from its
+        # parent directory so that it lands in dir_local as with scp
+        cmd_tar: list[str] = ["tar", "cf", "-"]
+        for entry in content:
+            entry = entry.rstrip("/")
+            dir_entry, name_entry = (
+                entry.rsplit("/", 1) if "/" in entry else (str(), entry)
+            )
+            # successive -C options are relative to each other, relative
+            # paths are then made explicit from the remote home directory
+            if entry.startswith("/"):
+                dir_entry = dir_entry or "/"
+            elif not entry.startswith("~"):
+                dir_entry = "~/" + dir_entry
+            cmd_tar += ["-C", quote_remote_path(dir_entry), quote(name_entry)]
+        # the remote command is parsed by the remote shell, which expands '~',
+        # the paths are then quoted beforehand
+        cmds_copy: list[list[str]] = [
+            ["ssh", address_server, " ".join(cmd_tar)],
+            ["tar", "xf", "-", "-C", dir_local],
+        ]
+    else:
+        cmd_copy: list[str] = ["scp"]
+
+        if type_of_content == "directory":
+            cmd_copy.append("-r")
+
+        for entry in content:
+            cmd_copy.append(f"{address_server}:{entry}")
+
+        cmd_copy.append(dir_local)
+        cmds_copy = [cmd_copy]
 
     # then, rename the files if needed
+    renamings: list[tuple[str, str]] = []
     if content_renaming is not None:
-        cmd_rename = str()
         if not isinstance(content_renaming, list):
             content_renaming = [content_renaming]
-        for i, (original_name, new_name) in enumerate(zip(content, content_renaming)):
+        for original_name, new_name in zip(content, content_renaming):
             original_name_wo_path: str = original_name.split("/")[-1]
-            cmd_rename += (
-                f" mv {dir_local}{original_name_wo_path} {dir_local}{new_name} "
+            renamings.append(
+                (f"{dir_local}{original_name_wo_path}", f"{dir_local}{new_name}")
             )
-            if i < len(content) - 1:
-                cmd_rename += " && "
-
-        cmd_total += " && " + cmd_rename
 
     if config["command"]["print"]:
-        Logger(f"Command line to copy data from remote:\n {cmd_copy}", "INFO")
+        Logger(
+            f"Command line to copy data from remote:\n {format_command(*cmds_copy)}",
+            "INFO",
+        )
         if content_renaming is not None:
+            cmd_rename: str = " && ".join(
+                format_command(["mv", *renaming]) for renaming in renamings
+            )
             Logger(f"Command line to rename local data:\n {cmd_rename}", "INFO")
     if config["command"]["run"]:
-        system(cmd_total)
+        run_command(*cmds_copy)
+        move_files(renamings)
 
 
 if __name__ == "__main__":
@@ -9,26 +9,31 @@ author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
 import os
+import re
 import sys
+from shutil import copyfile
 
 import ROOT as r
 
 try:
-    from yaml import load, FullLoader
+    from argparse import ArgumentParser
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from argparse import ArgumentParser
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'argparse' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
-    from utils import enforce_trailing_slash
+    from format_utils import enforce_trailing_slash
 except ModuleNotFoundError:
     print(
-        "Module 'utils' is not in the '../Utils/' directory. Add it to run this script."
+        "Module 'format_utils' is not in the '../Utils/' directory. Add it to run this script."
     )
 
 try:
@@ -39,6 +44,9 @@ except ModuleNotFoundError:
         "Module 'logger' is not in the '../Utils/' directory. Add it to run this script."
     )
 
+# suffix added by STIVI to the name of the flat trees
+FLAT_TREE_SUFFIX = re.compile(r"_?FlatTree$")
+
 
 # pylint: disable = "too-many-locals, too-many-branches, too-many-statements"
 def main(name_config_file: str, debug: bool = False) -> None:
@@ -55,9 +63,7 @@ def main(name_config_file: str, debug: bool = False) -> None:
     """
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     # handle input
     name_infiles = config["input"]["file"]
@@ -110,8 +116,19 @@ def main(name_config_file: str, debug: bool = False) -> None:
     if not isinstance(name_outfiles, list):
         name_outfiles = [name_outfiles] * len(name_infiles)
 
-    # enable multithreaded usage of RDataFrame
-    r.EnableImplicitMT(config["RDataFrame"]["EnableImplicitMT"])
+    # enable multithreaded usage of RDataFrame, with an explicit number of
+    # threads if given, all the cores being used otherwise
+    cfg_rdf: dict = config["RDataFrame"]
+    nthreads: int = int(cfg_rdf.get("nthreads") or 0)
+    if nthreads > 0:
+        r.EnableImplicitMT(nthreads)
+    elif cfg_rdf["EnableImplicitMT"] is True:
+        r.EnableImplicitMT()
+    elif cfg_rdf["EnableImplicitMT"]:  # former config, number of threads
+        r.EnableImplicitMT(int(cfg_rdf["EnableImplicitMT"]))
+
+    # input files already converted, (path, modification time, size) -> output file
+    converted_infiles: dict = {}
 
     # loop over all the input and output files
     for name_infile, name_outfile in zip(name_infiles, name_outfiles):
@@ -123,14 +140,10 @@ def main(name_config_file: str, debug: bool = False) -> None:
 
         # auto format output
         if auto_format_output:
-            name_infile_wo_path: str = name_infile.split("/")[-1]
-            name_infile_wo_suffix: str = name_infile_wo_path.replace(".root", str())
-            if "_FlatTree" in name_infile_wo_suffix:
-                name_infile_wo_suffix = name_infile_wo_suffix.replace(
-                    "_FlatTree", str()
-                )
-            elif "FlatTree" in name_infile_wo_suffix:
-                name_infile_wo_suffix = name_infile_wo_suffix.replace("FlatTree", str())
+            name_infile_wo_path: str = os.path.basename(name_infile)
+            name_infile_wo_suffix: str = FLAT_TREE_SUFFIX.sub(
+                str(), name_infile_wo_path.removesuffix(".root")
+            )
 
             # place the output file in dir/sub_dir/
             sub_dir_output: str = dir_output + enforce_trailing_slash(
@@ -147,26 +160,46 @@ def main(name_config_file: str, debug: bool = False) -> None:
                 Logger(f"Output dir: {dir_output}", "DEBUG")
             Logger(f"Output file: {name_outfile}", "DEBUG")
 
-        # warning if output directory exists, else make it
-        if os.path.isdir(dir_output):
+        # make output directory, warning if it already exists
+        try:
+            os.makedirs(dir_output)
+            print("\n")
+        except FileExistsError:
             log_dir_output = f"Output directory'{dir_output}'"
             log_dir_output += " already exists,"
             log_dir_output += " overwrites possibly ongoing!\n"
             Logger(log_dir_output, "WARNING")
-        else:
-            os.makedirs(dir_output)
-            print("\n")
 
         if auto_format_output:
-            # warning if output sub directory exists, else make it
-            if os.path.isdir(sub_dir_output):
+            # make output sub directory, warning if it already exists
+            try:
+                os.makedirs(sub_dir_output)
+                print("\n")
+            except FileExistsError:
                 log_sub_dir_output = f"Output sub directory'{sub_dir_output}'"
                 log_sub_dir_output += " already exists,"
                 log_sub_dir_output += " overwrites possibly ongoing!\n"
                 Logger(log_sub_dir_output, "WARNING")
-            else:
-                os.makedirs(sub_dir_output)
-                print("\n")
+
+        # an input file given several times is converted only once
+        stat_infile = os.stat(name_infile)
+        key_infile: tuple = (
+            os.path.realpath(name_infile),
+            stat_infile.st_mtime_ns,
+            stat_infile.st_size,
+        )
+        if key_infile in converted_infiles:
+            name_converted_file: str = converted_infiles[key_infile]
+            if os.path.realpath(name_converted_file) != os.path.realpath(
+                name_outfile
+            ):
+                copyfile(name_converted_file, name_outfile)
+            Logger(
+                f"Input file {name_infile} already converted into {name_converted_file}",
+                "INFO",
+            )
+            continue
+        converted_infiles[key_infile] = name_outfile
 
         # convert input .root file into RDataFrame
         infile: r.TFile = r.TFile.Open(name_infile)
@@ -175,15 +208,16 @@ def main(name_config_file: str, debug: bool = False) -> None:
 
         # TODO add triple coincidence flag in the TTree (from cfg file)
 
-        # compute kinetic energy before Pl1 and Pl2
+        # compute kinetic energy before Pl2, then before Pl1 from the former
         df_with_ec = df.Define(
             name_ec_pl2, f"{name_dnrj_cebr} + {name_dnrj_pl2}"
-        ).Define(name_ec_pl1, f"{name_dnrj_cebr} + {name_dnrj_pl2} + {name_dnrj_pl1}")
+        ).Define(name_ec_pl1, f"{name_ec_pl2} + {name_dnrj_pl1}")
 
+        # rename the (Delta) E branches, aliases do not copy the columns
         df_new = (
-            df_with_ec.Define(name_new_branches[0], name_dnrj_pl1)
-            .Define(name_new_branches[1], name_dnrj_pl2)
-            .Define(name_new_branches[2], name_dnrj_cebr)
+            df_with_ec.Alias(name_new_branches[0], name_dnrj_pl1)
+            .Alias(name_new_branches[1], name_dnrj_pl2)
+            .Alias(name_new_branches[2], name_dnrj_cebr)
         )
 
         # QA histograms
@@ -204,13 +238,21 @@ def main(name_config_file: str, debug: bool = False) -> None:
                 [name_ec_pl1, name_dnrj_pl1],
             ]
 
-            # retrieve mins and maxs of each distribution
-            xmins, xmaxs, ymins, ymaxs = [], [], [], []
+            # retrieve mins and maxs of each distribution, booked lazily and
+            # run together so that the input is read once for all of them
+            lazy_mins_maxs = []
             for axes in h_branches_to_plot:
-                xmins.append(df_new.Min(axes[0]).GetValue())
-                xmaxs.append(df_new.Max(axes[0]).GetValue())
-                ymins.append(df_new.Min(axes[1]).GetValue())
-                ymaxs.append(df_new.Max(axes[1]).GetValue())
+                lazy_mins_maxs += [
+                    df_new.Min(axes[0]),
+                    df_new.Max(axes[0]),
+                    df_new.Min(axes[1]),
+                    df_new.Max(axes[1]),
+                ]
+            r.RDF.RunGraphs(lazy_mins_maxs)
+            xmins = [res.GetValue() for res in lazy_mins_maxs[0::4]]
+            xmaxs = [res.GetValue() for res in lazy_mins_maxs[1::4]]
+            ymins = [res.GetValue() for res in lazy_mins_maxs[2::4]]
+            ymaxs = [res.GetValue() for res in lazy_mins_maxs[3::4]]
 
             # axes configurations
             h_axes_config = []
@@ -221,28 +263,36 @@ def main(name_config_file: str, debug: bool = False) -> None:
             for name, title, axes_config in zip(h_names, h_titles, h_axes_config):
                 h_configs.append((name, title, *axes_config))
 
-            # FIXME I did not find a way to save these in a list
-            h1 = df_new.Histo2D(h_configs[0], *h_branches_to_plot[0])
-            h2 = df_new.Histo2D(h_configs[1], *h_branches_to_plot[1])
-            h3 = df_new.Histo2D(h_configs[2], *h_branches_to_plot[2])
-            h4 = df_new.Histo2D(h_configs[3], *h_branches_to_plot[3])
+            hists = [
+                df_new.Histo2D(h_config, *branches)
+                for h_config, branches in zip(h_configs, h_branches_to_plot)
+            ]
 
-        # save dataframe in output .root file
+        # save dataframe in output .root file, the snapshot is booked lazily
+        # so that the QA histograms are filled within the same event loop
+        snapshot_options = r.RDF.RSnapshotOptions()
+        snapshot_options.fLazy = True
+        # LZ4 is much faster to write than the default ZLIB
+        snapshot_options.fCompressionAlgorithm = (
+            r.ROOT.RCompressionSetting.EAlgorithm.kLZ4
+        )
+        snapshot_options.fCompressionLevel = 1
         if config["output"]["save_nrj_info_only"]:
             saved_branches = [*name_new_branches, name_ec_pl1, name_ec_pl2]
-            df_new.Snapshot(name_out_tree, name_outfile, {*saved_branches})
         else:
-            df_new.Snapshot(name_out_tree, name_outfile)
+            saved_branches = str()  # empty regex, all the columns are saved
+        snapshot = df_new.Snapshot(
+            name_out_tree, name_outfile, saved_branches, snapshot_options
+        )
+        r.RDF.RunGraphs([snapshot, *hists] if do_qa else [snapshot])
 
         infile.Close()
 
         if do_qa:
             # add 2d QA plots to the output .root file
             outfile: r.TFile = r.TFile.Open(name_outfile, "UPDATE")
-            h1.Write()
-            h2.Write()
-            h3.Write()
-            h4.Write()
+            for hist in hists:
+                hist.Write()
             outfile.Close()
 
 
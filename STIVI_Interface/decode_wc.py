@@ -6,18 +6,33 @@ note:
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
-from os import system
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import cpu_count
+from shlex import join, quote, split
+import subprocess
 import sys
 
 try:
-    from yaml import load, FullLoader
+    from argparse import ArgumentParser
 except ModuleNotFoundError:
-    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+    print("Module 'argparse' is not installed. Please install it to run this script.")
 
 try:
-    from argparse import ArgumentParser
+    sys.path.append("../Utils/")
+    from yaml_cache import load_yaml
 except ModuleNotFoundError:
-    print("Module 'argparse' is not installed. Please install it to run this script.")
+    print(
+        "Module 'yaml_cache' is not in the '../Utils/' directory. Add it to run this script."
+    )
+
+try:
+    sys.path.append("../Utils/")
+    from command_utils import format_command, move_files, run_command
+except ModuleNotFoundError:
+    print(
+        "Module 'command_utils' is not in the '../Utils/' directory. Add it to run this script."
+    )
 
 try:
     sys.path.append("../Utils/")
@@ -43,19 +58,21 @@ def main(name_config_file: str, debug: bool) -> None:
     """
 
     # import configuration
-    config: dict = {}
-    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
-        config = load(yml_config_file, FullLoader)
+    config: dict = load_yaml(name_config_file)
 
     my_input = config["DecodeWC"]["input"]
     name_output = config["DecodeWC"]["output"]["name"]
-    use_stivi_merge: bool = config["DecodeWC"]["use_stivi_merge"]
-    merge_output: bool = config["DecodeWC"]["output"]["merge"]["activate"]
-    rm_tmp_file: bool = config["DecodeWC"]["output"]["merge"]["rm_tmp_file"]
+    use_stivi_merge: bool = config["DecodeWC"].get("use_stivi_merge", False)
+    cfg_merge = config["DecodeWC"]["output"].get("merge")
+    if not isinstance(cfg_merge, dict):  # former config, 'merge' is a boolean
+        cfg_merge = {"activate": cfg_merge}
+    merge_output: bool = bool(cfg_merge.get("activate"))
+    rm_tmp_file: bool = bool(cfg_merge.get("rm_tmp_file"))
     exp = config["DecodeWC"]["exp"]
     run = config["DecodeWC"]["run"]
     flat: bool = config["DecodeWC"]["flat"]
-    extra_option = config["DecodeWC"]["extra_option"]
+    extra_option = config["DecodeWC"].get("extra_option")
+    parallel: bool = config["DecodeWC"].get("parallel", False)
 
     # safeties
     if isinstance(my_input, list) and isinstance(name_output, list):
@@ -96,12 +113,10 @@ def main(name_config_file: str, debug: bool) -> None:
             "WARNING",
         )
 
+    # all the commands are run from the STIVI Reconstruction directory
     name_stivi_reco_dir: str = config["STIVI"]["Reconstruction_dir"]
-
-    # go to STIVI Reconstruction directory
-    cd_stivi: str = f"cd {name_stivi_reco_dir}"
     if debug:
-        Logger(f"Command to go to STIVI Reconstruction directory: {cd_stivi}", "DEBUG")
+        Logger(f"STIVI Reconstruction directory: {name_stivi_reco_dir}", "DEBUG")
 
     # enforce list if my_input (hence neither output) is a list
     if not isinstance(my_input, list):
@@ -119,61 +134,72 @@ def main(name_config_file: str, debug: bool) -> None:
         if not isinstance(name_output, list):
             name_output = [name_output] * n_input
 
-    cmd_decode_wc = ""
-
-    for i, (in_, out_, exp_, run_, flat_) in enumerate(
-        zip(my_input, name_output, exp, run, flat)
-    ):
-        cmd_decode_wc += f"DecodeWC -in {in_} -out {out_} -exp {exp_} -run {run_}"
+    cmds_decode_wc: list[list[str]] = []
+    for in_, out_, exp_, run_, flat_ in zip(my_input, name_output, exp, run, flat):
+        cmd_decode_wc: list[str] = ["DecodeWC", "-in", in_, "-out", out_]
+        cmd_decode_wc += ["-exp", str(exp_), "-run", str(run_)]
         if flat_:
-            cmd_decode_wc += " -flat"
+            cmd_decode_wc.append("-flat")
         if extra_option is not None:
-            cmd_decode_wc += " " + extra_option
+            cmd_decode_wc += split(extra_option)
+        cmds_decode_wc.append(cmd_decode_wc)
 
-        if i < n_input - 1:
-            cmd_decode_wc += " && "
+    # the DecodeWC invocations are independent, they can run in parallel
+    n_parallel: int = max(1, min(n_input, cpu_count())) if parallel else 1
 
     if debug:
-        Logger(f"Command to DecodeWC: {cmd_decode_wc}", "DEBUG")
+        for cmd_decode_wc in cmds_decode_wc:
+            Logger(f"Command to DecodeWC: {join(cmd_decode_wc)}", "DEBUG")
 
     # STIVI adds '_FlatTree' before '.root' when flat option enabled
-    # so we need to take it into account for the merge and rm commands
-    if flat:
-        name_output = [
-            name.replace(".root", str()) + "_FlatTree.root"
-            for name in name_output.copy()
-        ]
-
-    cmd_merge = ""
-    if merge_output:
-        cmd_merge += f"hadd {config['DecodeWC']['output']['name']} "
-        for name in name_output:
-            cmd_merge += f"{name} "
-
-    cmd_rm: str = ""
-    if merge_output and rm_tmp_file:
-        cmd_rm = "rm " + str(" ").join(name_output)
-
-    cmd: str = cd_stivi + " && " + cmd_decode_wc
+    # so we need to take it into account for the merge, rm and mv commands
+    name_output = [
+        name.replace(".root", str()) + "_FlatTree.root" if flat_ else name
+        for name, flat_ in zip(name_output, flat)
+    ]
+
+    cmds: list[list[str]] = []
+    renamings: list[tuple[str, str]] = []
     if merge_output:
-        cmd += " && " + cmd_merge
+        cmds.append(["hadd", config["DecodeWC"]["output"]["name"], *name_output])
         if rm_tmp_file:
-            cmd += " && " + cmd_rm
+            cmds.append(["rm", *name_output])
     else:
-        cmd_rename = str()
-        for i, name in enumerate(name_output):
-            cmd_rename += f"mv {name} {name.replace('_FlatTree', str())}"
-            if i < n_input - 1:
-                cmd_rename += " && "
-        cmd += " && " + cmd_rename
+        for name in name_output:
+            if "_FlatTree" in name:
+                renamings.append((name, name.replace("_FlatTree", str())))
 
     if config["command"]["print"]:
+        cmd: str = " && ".join(
+            [f"cd {quote(name_stivi_reco_dir)}"]
+            + [format_command(cmd_) for cmd_ in cmds_decode_wc + cmds]
+            + [format_command(["mv", *renaming]) for renaming in renamings]
+        )
         Logger(
             f"Enter this command line to DecodeWC with selected configuration:\n\n{cmd}",
             "INFO",
         )
     if config["command"]["run"]:
-        system(cmd)
+        # a new invocation starts as soon as a slot is free, so that a slow
+        # input does not hold the others
+        run_decode_wc = partial(subprocess.run, cwd=name_stivi_reco_dir, check=False)
+        with ThreadPoolExecutor(n_parallel) as executor:
+            futures: list = [executor.submit(run_decode_wc, c) for c in cmds_decode_wc]
+            for cmd_, future in zip(cmds_decode_wc, futures):
+                error: str = str()
+                try:
+                    returncode: int = future.result().returncode
+                    if returncode != 0:
+                        error = f"failed with return code {returncode}"
+                except OSError as err:
+                    error = f"cannot be run: {err}"
+                if error:
+                    # the invocations not started yet are dropped
+                    executor.shutdown(cancel_futures=True)
+                    Logger(f"Command '{join(cmd_)}' {error}", "FATAL")
+        for cmd_ in cmds:
+            run_command(cmd_, cwd=name_stivi_reco_dir)
+        move_files(renamings, cwd=name_stivi_reco_dir)
 
 
 if __name__ == "__main__":
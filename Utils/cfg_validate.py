@@ -0,0 +1,114 @@
+"""
+file: cfg_validate.py
+brief: Validation of the YAML config files of the calibration scripts
+usage:
+note: the configs are validated once, right after being loaded, so that a
+      wrong config stops the script before any input is read
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+from format_utils import enforce_list
+
+POSSIBLE_FIT_FUNCS = ["gaus", "lorentz", "crystalball"]
+POSSIBLE_FIT_BACKENDS = ["roofit", "scipy"]
+
+# entries required in the config of each kind of script
+REQUIRED_KEYS: dict = {
+    "fit": [
+        ("input", "file"),
+        ("input", "tree", "name"),
+        ("input", "tree", "branches"),
+        ("histogram_config", "name"),
+        ("histogram_config", "nbin"),
+        ("fit", "range"),
+        ("fit", "pars"),
+        ("output", "file"),
+        ("output", "plot", "label"),
+        ("output", "plot", "ymin"),
+        ("output", "plot", "ymax"),
+        ("output", "plot", "info"),
+    ],
+    "plot_fit": [
+        ("input", "file"),
+        ("input", "data"),
+        ("input", "fit_func"),
+        ("plot", "label"),
+        ("plot", "info"),
+        ("output", "file"),
+        ("output", "extension"),
+    ],
+}
+
+# entries that must be lists of the same size
+SAME_SIZE_KEYS: dict = {
+    "fit": [("input", "tree", "branches"), ("histogram_config", "name")],
+    "plot_fit": [("input", "data"), ("plot", "label"), ("output", "file")],
+}
+
+
+def get_entry(config: dict, keys: tuple):
+    """
+    Helper method to get a nested entry of a config
+
+    Parameters
+    ------------------------------------------------
+    - config: dict
+        Content of the config file
+
+    - keys: tuple
+        Keys of the entry, from the outermost to the innermost
+
+    Returns
+    ------------------------------------------------
+    - entry:
+        Entry of the config
+    """
+
+    entry = config
+    for key in keys:
+        if not isinstance(entry, dict) or key not in entry:
+            raise ValueError(f"Entry '{'/'.join(keys)}' missing in the config!")
+        entry = entry[key]
+
+    return entry
+
+
+def validate(config: dict, kind: str) -> None:
+    """
+    Helper method to check a config once for all, raising a ValueError if
+    it is not valid
+
+    Parameters
+    ------------------------------------------------
+    - config: dict
+        Content of the config file
+
+    - kind: str
+        Kind of script using the config, 'fit' or 'plot_fit'
+    """
+
+    if kind not in REQUIRED_KEYS:
+        raise ValueError(f"Config kind '{kind}' not in {list(REQUIRED_KEYS)}")
+
+    for keys in REQUIRED_KEYS[kind]:
+        get_entry(config, keys)
+
+    sizes: list[int] = [
+        len(enforce_list(get_entry(config, keys))) for keys in SAME_SIZE_KEYS[kind]
+    ]
+    if len(set(sizes)) > 1:
+        names: str = ", ".join(f"'{'/'.join(keys)}'" for keys in SAME_SIZE_KEYS[kind])
+        raise ValueError(f"{names} must be of same size!")
+
+    if kind == "fit":
+        backend = config["fit"].get("backend", "roofit")
+        if backend not in POSSIBLE_FIT_BACKENDS:
+            raise ValueError(
+                f"Fit backend '{backend}' not in {POSSIBLE_FIT_BACKENDS}"
+            )
+    elif kind == "plot_fit":
+        for func_fit in enforce_list(config["input"]["fit_func"]):
+            if func_fit not in POSSIBLE_FIT_FUNCS:
+                raise ValueError(
+                    f"The 'input/fit_func' options must be in {POSSIBLE_FIT_FUNCS}!"
+                )
@@ -0,0 +1,99 @@
+"""
+file: command_utils.py
+brief: Helpers to print and run command lines without going through a shell
+usage:
+note: a command is given as a list of arguments (argv), several commands can
+      be chained with a pipe, the output of each one being the input of the
+      next one
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+from os.path import join as join_path
+from shlex import join
+from shutil import move
+from subprocess import PIPE, Popen
+
+from logger import Logger
+
+
+def format_command(*cmds: list[str]) -> str:
+    """
+    Helper method to format piped commands as a shell command line
+
+    Parameters
+    ------------------------------------------------
+    - cmds: list[str]
+        Arguments of each command, in the order of the pipe
+
+    Returns
+    ------------------------------------------------
+    - :str
+        Command line that can be entered in a shell
+    """
+
+    return " | ".join(join(cmd) for cmd in cmds)
+
+
+def run_command(*cmds: list[str], cwd: str = None) -> None:
+    """
+    Helper method to run piped commands, stopping the script if one of them
+    fails
+
+    Parameters
+    ------------------------------------------------
+    - cmds: list[str]
+        Arguments of each command, in the order of the pipe
+
+    - cwd: str
+        Directory in which the commands are run, current one if None
+    """
+
+    procs: list[Popen] = []
+    try:
+        stdin = None
+        for i, cmd in enumerate(cmds):
+            proc = Popen(
+                cmd, stdin=stdin, stdout=PIPE if i < len(cmds) - 1 else None, cwd=cwd
+            )
+            if stdin is not None:
+                # only the next command reads it, so that the previous one is
+                # notified if the next one exits
+                stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+    except OSError as err:
+        Logger(f"Command '{format_command(*cmds)}' cannot be run: {err}", "FATAL")
+
+    for proc in procs:
+        proc.wait()
+    for proc in procs:
+        if proc.returncode != 0:
+            Logger(
+                f"Command '{format_command(*cmds)}' failed"
+                + f" with return code {proc.returncode}",
+                "FATAL",
+            )
+
+
+def move_files(names: list[tuple[str, str]], cwd: str = None) -> None:
+    """
+    Helper method to move (rename) files within the running process, as a
+    faster equivalent of one 'mv' command per file, stopping the script if
+    one of them cannot be moved
+
+    Parameters
+    ------------------------------------------------
+    - names: list[tuple[str, str]]
+        Current and new names of each file
+
+    - cwd: str
+        Directory of the relative names, current one if None
+    """
+
+    for name_src, name_dst in names:
+        if cwd is not None:
+            name_src, name_dst = join_path(cwd, name_src), join_path(cwd, name_dst)
+        try:
+            move(name_src, name_dst)
+        except OSError as err:
+            Logger(f"File {name_src} cannot be moved to {name_dst}: {err}", "FATAL")
@@ -6,17 +6,45 @@ note:
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
-from utils import configure_canvas
+from functools import lru_cache
+
+from utils import configure_canvas, th1_errors_to_ndarray, th1_to_ndarray
 from format_utils import enforce_list
 from style_formatter import set_global_style, set_object_style
+from logger import Logger
 import ROOT as r
-from numpy import arange
+from numpy import (
+    append,
+    arange,
+    array,
+    asarray,
+    ceil,
+    diag,
+    exp,
+    eye,
+    interp,
+    log,
+    ndarray,
+    outer,
+    polyfit,
+    sqrt,
+    zeros,
+)
+from numpy.fft import irfft, rfft
+from numpy.polynomial.polynomial import polyval
 
 try:
     from math import pi
 except ModuleNotFoundError:
     print("Module 'math' is not installed. Please install it to run this script.")
 
+try:
+    from numpy.linalg import inv
+    from scipy.optimize import curve_fit, minimize
+    from scipy.special import ndtr
+except ModuleNotFoundError:
+    print("Module 'scipy' is not installed. Please install it to run this script.")
+
 
 # # pylint: disable=too-few-public-methods
 # class Lorentzian:
@@ -32,38 +60,190 @@ except ModuleNotFoundError:
 #         return num / den
 
 
+MAX_SIZE_CACHE_LANGAU: int = 4096  # maximum number of values cached per function
+N_GRID_LANGAUS: int = 4096  # number of points of the FFT convolution of LanGaus
+
+# coefficients of the CERNLIB DENLAN approximation of the Landau density, as
+# in ROOT::Math::landau_pdf: (lower edge, upper edge, numerator, denominator,
+# whether the rational function is in 1/v) for each interval of the reduced
+# variable v = (x - mpv) / sigma between -1 and 300
+LANDAU_RATIONALS: list[tuple] = [
+    (
+        -1.0,
+        1.0,
+        (0.1788541609, 0.1173957403, 0.01488850518, -0.001394989411, 0.0001283617211),
+        (1.0, 0.7428795082, 0.3153932961, 0.06694219548, 0.008790609714),
+        False,
+    ),
+    (
+        1.0,
+        5.0,
+        (0.1788544503, 0.09359161662, 0.006325387654, 6.611667319e-5, -2.031049101e-6),
+        (1.0, 0.6097809921, 0.2560616665, 0.04746722384, 0.006957301675),
+        False,
+    ),
+    (
+        5.0,
+        12.0,
+        (0.9874054407, 118.6723273, 849.2794360, -743.7792444, 427.0262186),
+        (1.0, 106.8615961, 337.6496214, 2016.712389, 1597.063511),
+        True,
+    ),
+    (
+        12.0,
+        50.0,
+        (1.003675074, 167.5702434, 4789.711289, 21217.86767, -22324.94910),
+        (1.0, 156.9424537, 3745.310488, 9834.698876, 66924.28357),
+        True,
+    ),
+    (
+        50.0,
+        300.0,
+        (1.000827619, 664.9143136, 62972.92665, 475554.6998, -5743609.109),
+        (1.0, 651.4101098, 56974.73333, 165917.4725, -2815759.939),
+        True,
+    ),
+]
+LANDAU_P1: tuple = (
+    0.4259894875,
+    -0.1249762550,
+    0.03984243700,
+    -0.006298287635,
+    0.001511162253,
+)
+LANDAU_Q1: tuple = (1.0, -0.3388260629, 0.09594393323, -0.01608042283, 0.003778942063)
+LANDAU_A1: tuple = (0.04166666667, -0.01996527778, 0.02709538966)
+LANDAU_A2: tuple = (-1.845568670, -4.284640743)
+
+
+def landau_pdf(x, mpv: float, sigma: float):
+    """
+    Helper method to evaluate the Landau density as TMath::Landau (not
+    normalised) on a numpy array, without calling ROOT for each value
+
+    Parameters
+    ------------------------------------------------
+    - x: np.ndarray
+        Values where the density is evaluated
+
+    - mpv: float
+        Location parameter of the Landau density
+
+    - sigma: float
+        Scale parameter of the Landau density
+
+    Returns
+    ------------------------------------------------
+    - den: np.ndarray
+        Landau density at each value
+    """
+
+    if sigma <= 0:
+        return zeros(asarray(x).shape)
+    v = (asarray(x, dtype=float) - mpv) / sigma
+    den = zeros(v.shape)
+
+    # left tail, negligible below exp(v + 1) = 1e-10
+    sel = (v < -5.5) & (v >= log(1e-10) - 1.0)
+    u = exp(v[sel] + 1.0)
+    den[sel] = (
+        0.3989422803
+        * exp(-1.0 / u)
+        / sqrt(u)
+        * (1.0 + (LANDAU_A1[0] + (LANDAU_A1[1] + LANDAU_A1[2] * u) * u) * u)
+    )
+
+    sel = (v >= -5.5) & (v < -1.0)
+    u = exp(-v[sel] - 1.0)
+    den[sel] = (
+        exp(-u) * sqrt(u) * polyval(v[sel], LANDAU_P1) / polyval(v[sel], LANDAU_Q1)
+    )
+
+    for v_min, v_max, coeffs_p, coeffs_q, in_inverse in LANDAU_RATIONALS:
+        sel = (v >= v_min) & (v < v_max)
+        if in_inverse:
+            u = 1.0 / v[sel]
+            den[sel] = u * u * polyval(u, coeffs_p) / polyval(u, coeffs_q)
+        else:
+            den[sel] = polyval(v[sel], coeffs_p) / polyval(v[sel], coeffs_q)
+
+    # right tail
+    sel = v >= 300.0
+    u = 1.0 / (v[sel] - v[sel] * log(v[sel]) / (v[sel] + 1.0))
+    den[sel] = u * u * (1.0 + (LANDAU_A2[0] + LANDAU_A2[1] * u) * u)
+
+    return den
+
+
 def langaufun(x, par):
     # par[0] = Landau MPV
     # par[1] = Landau width
     # par[2] = Gaussian sigma
     # par[3] = normalization
 
+    # the fit evaluates the function many times at the same bin centres with
+    # the same parameters, the values are then cached
+    return _langaufun(x[0], par[0], par[1], par[2], par[3])
+
+
+@lru_cache(maxsize=MAX_SIZE_CACHE_LANGAU)
+def _langaufun(x0: float, mpv_landau: float, width: float, sigma: float, norm: float):
+    """
+    Helper method to compute langaufun at a given point, see langaufun for
+    the parameters
+    """
+
     invsq2pi = 0.3989422804014
     mpshift = -0.22278298
 
-    mpv = par[0] - mpshift * par[1]
-    sum_ = 0.0
+    mpv = mpv_landau - mpshift * width
     np = 100
     sc = 5.0
 
-    xlow = x[0] - sc * par[2]
-    xupp = x[0] + sc * par[2]
+    xlow = x0 - sc * sigma
+    xupp = x0 + sc * sigma
     step = (xupp - xlow) / np
 
-    for i in range(np):
-        xx = xlow + (i + 0.5) * step
-        land = r.TMath.Landau(xx, mpv, par[1]) / par[1]
-        gaus = r.TMath.Gaus(x[0], xx, par[2])
-        sum_ += land * gaus
+    # the whole convolution is evaluated with array operations
+    xx = xlow + (arange(np) + 0.5) * step
+    land = landau_pdf(xx, mpv, width) / width
+    gaus = exp(-0.5 * ((x0 - xx) / sigma) ** 2)  # TMath::Gaus, not normalised
+    sum_ = land.dot(gaus)
 
-    return par[3] * step * sum_ * invsq2pi / par[2]
+    return norm * step * sum_ * invsq2pi / sigma
 
 
 class LanGaus:
     """
-    Docstring pour LanGaus
+    Landau convoluted with a Gaussian, as a TF1 functor. If the range of the
+    fit is given, the convolution is computed once per set of parameters by
+    FFT on a grid covering the range, and interpolated at each point
     """
 
+    def __init__(self, xmin=None, xmax=None, n_grid: int = N_GRID_LANGAUS):
+        """
+        Parameters
+        ------------------------------------------------
+        - xmin: float
+            Lower edge of the range of the fit, direct convolution at each
+            point if None
+
+        - xmax: float
+            Upper edge of the range of the fit, direct convolution at each
+            point if None
+
+        - n_grid: int
+            Number of points of the grid of the FFT convolution
+        """
+
+        self.xmin = xmin
+        self.xmax = xmax
+        self.n_grid = n_grid
+        # last parameters of the FFT convolution and its values on the grid
+        self._pars_grid: tuple = ()
+        self._x_grid = None
+        self._values_grid = None
+
     def __call__(self, x, par):
 
         # Fit parameters:
@@ -77,36 +257,126 @@ class LanGaus:
         # This shift is corrected within this function, so that the actual
         # maximum is identical to the MP parameter.
 
-        # Numeric constants
-        invsq2pi = 0.3989422804014  # (2 pi)^(-1/2)
-        mpshift = -0.22278298  # Landau maximum location
-        # Control constants
-        np = 100  # number of convolution steps
-        sc = 5.0  # convolution extends to +-sc Gaussian sigmas
+        pars: tuple = (par[0], par[1], par[2], par[3])
+        # direct convolution without range, outside the grid (the interpolation
+        # would be clamped to its edges) and without Gaussian kernel
+        if (
+            self.xmin is None
+            or self.xmax is None
+            or not self.xmin <= x[0] <= self.xmax
+            or pars[3] <= 0
+        ):
+            # the values are cached, as for langaufun
+            return _langaus(x[0], *pars)
+
+        # the fit evaluates all the points with the same parameters, the
+        # convolution is then computed once for all of them
+        if pars != self._pars_grid:
+            self._x_grid, self._values_grid = _langaus_fft(
+                self.xmin, self.xmax, self.n_grid, *pars
+            )
+            self._pars_grid = pars
+
+        return float(interp(x[0], self._x_grid, self._values_grid))
+
+
+def _langaus_fft(
+    xmin: float,
+    xmax: float,
+    n_grid: int,
+    width: float,
+    mp: float,
+    area: float,
+    sigma: float,
+) -> tuple:
+    """
+    Helper method to compute LanGaus on a uniform grid covering a range,
+    with a FFT convolution of the Landau density and the Gaussian kernel
+
+    Parameters
+    ------------------------------------------------
+    - xmin: float
+        Lower edge of the range
+
+    - xmax: float
+        Upper edge of the range
+
+    - n_grid: int
+        Number of points of the grid
+
+    - width, mp, area, sigma: float
+        Parameters of LanGaus
+
+    Returns
+    ------------------------------------------------
+    - x_grid: np.ndarray
+        Points of the grid
+
+    - values: np.ndarray
+        Values of LanGaus at these points
+    """
+
+    invsq2pi = 0.3989422804014  # (2 pi)^(-1/2)
+    mpshift = -0.22278298  # Landau maximum location
+    sc = 5.0  # convolution extends to +-sc Gaussian sigmas
 
-        # Variables
-        sum = 0.0
+    mpc = mp - mpshift * width
 
-        #   MP shift correction
-        mpc = par[1] - mpshift * par[0]
+    # the Landau density is sampled sc sigmas beyond the range, so that the
+    # kernel is fully covered for all the points of the range
+    step = (xmax - xmin) / (n_grid - 1)
+    n_kernel = int(ceil(sc * sigma / step))
+    x_landau = xmin + arange(-n_kernel, n_grid + n_kernel) * step
+    fland = landau_pdf(x_landau, mpc, width) / width
+    offsets = arange(-n_kernel, n_kernel + 1) * step
+    kernel = exp(-0.5 * (offsets / sigma) ** 2) * invsq2pi / sigma
 
-        #    Range of convolution integral
-        xlow = x[0] - sc * par[3]
-        xupp = x[0] + sc * par[3]
+    # linear convolution, zero padded to avoid the circular wrapping
+    n_fft = fland.size + kernel.size - 1
+    conv = irfft(rfft(fland, n_fft) * rfft(kernel, n_fft), n_fft)
 
-        step = (xupp - xlow) / np
+    # conv[i] is centred on x_landau[i - n_kernel], the range starts at
+    # x_landau[n_kernel]
+    x_grid = xmin + arange(n_grid) * step
+    values = area * step * conv[2 * n_kernel : 2 * n_kernel + n_grid]
 
-        # Convolution integral of Landau and Gaussian by sum
-        for i in range(np):
-            xx = xlow + (i - 0.5) * step
-            fland = r.TMath.Landau(xx, mpc, par[0]) / par[0]
-            sum += fland * r.TMath.Gaus(x[0], xx, par[3])
+    return x_grid, values
 
-            xx = xupp - (i - 0.5) * step
-            fland = r.TMath.Landau(xx, mpc, par[0]) / par[0]
-            sum += fland * r.TMath.Gaus(x[0], xx, par[3])
 
-        return par[2] * step * sum * invsq2pi / par[3]
+@lru_cache(maxsize=MAX_SIZE_CACHE_LANGAU)
+def _langaus(x0: float, width: float, mp: float, area: float, sigma: float):
+    """
+    Helper method to compute LanGaus at a given point, see LanGaus for the
+    parameters
+    """
+
+    # Numeric constants
+    invsq2pi = 0.3989422804014  # (2 pi)^(-1/2)
+    mpshift = -0.22278298  # Landau maximum location
+    # Control constants
+    np = 100  # number of convolution steps
+    sc = 5.0  # convolution extends to +-sc Gaussian sigmas
+
+    #   MP shift correction
+    mpc = mp - mpshift * width
+
+    # no smearing, the convolution is the Landau density itself
+    if sigma == 0:
+        return area * float(landau_pdf(x0, mpc, width)) / width
+
+    #    Range of convolution integral
+    xlow = x0 - sc * sigma
+    xupp = x0 + sc * sigma
+
+    step = (xupp - xlow) / np
+
+    # Convolution integral of Landau and Gaussian by sum, all the midpoints
+    # being evaluated in a single array, as in langaufun
+    xx = xlow + (arange(np) + 0.5) * step
+    fland = landau_pdf(xx, mpc, width) / width
+    sum_ = fland.dot(exp(-0.5 * ((x0 - xx) / sigma) ** 2))
+
+    return area * step * sum_ * invsq2pi / sigma
 
 
 def lorentzian():
@@ -118,6 +388,191 @@ def lorentzian():
     return num + "/ (" + den + ")"
 
 
+# TFormula expression of Birks law, compiled once by ROOT and shared by all the
+# TF1 built with it, parameters are S, A_0 and Kb
+BIRKS_LAW: str = "([0] * x + [1]) / (1 + [2] * x)"
+
+
+def birks_law(edep, s, a0, kb):
+    """
+    Birks law for calibration fit
+
+    Parameters
+    ------------------------------------------------
+    - edep: np.ndarray
+        Deposited energy
+
+    - s, a0, kb: float
+        Slope, offset and Birks' constant
+
+    Returns
+    ------------------------------------------------
+    - response: np.ndarray
+        Response of the scintillator
+    """
+
+    return (s * edep + a0) / (1 + kb * edep)
+
+
+# pylint:disable=too-many-arguments
+def fit_birks(x, y, unc_x, unc_y, kb=None, n_iterations: int = 3) -> tuple:
+    """
+    Helper method to fit Birks law with a least-squares fit on numpy arrays.
+    As done by ROOT for a TGraphErrors, the uncertainties on x are propagated
+    through the slope of the function (effective variance), which is updated
+    with the parameters of the previous iteration
+
+    Parameters
+    ------------------------------------------------
+    - x, y: np.ndarray
+        Deposited energy and response of the scintillator
+
+    - unc_x, unc_y: np.ndarray
+        Uncertainties on x and y
+
+    - kb: float
+        Value at which Birks' constant is fixed, free parameter if None
+
+    - n_iterations: int
+        Number of fits with an updated effective variance
+
+    Returns
+    ------------------------------------------------
+    - chi2: float
+        Chi2 of the fit
+
+    - ndf: int
+        Number of degrees of freedom of the fit
+
+    - params: np.ndarray
+        S, A_0 and Kb
+
+    - unc_params: np.ndarray
+        Uncertainties on the parameters, 0 for a fixed one
+    """
+
+    # a straight line is a good enough starting point for small Kb
+    p0: list[float] = list(polyfit(x, y, 1))
+    if kb is None:
+        func = birks_law
+        p0.append(0.0)
+    else:
+
+        def func(edep, s, a0):
+            return birks_law(edep, s, a0, kb)
+
+    sigma = unc_y
+    for _ in range(n_iterations):
+        try:
+            popt, pcov = curve_fit(func, x, y, p0=p0, sigma=sigma, absolute_sigma=True)
+        except RuntimeError as err:
+            Logger(f"Fit with Birks law did not converge: {err}", "FATAL")
+        params = popt if kb is None else append(popt, kb)
+        slope = (params[0] - params[1] * params[2]) / (1 + params[2] * x) ** 2
+        sigma = sqrt(unc_y**2 + (slope * unc_x) ** 2)
+        p0 = list(popt)
+
+    chi2: float = float((((y - func(x, *popt)) / sigma) ** 2).sum())
+    ndf: int = len(x) - len(popt)
+    unc_params = sqrt(diag(pcov))
+    if kb is not None:
+        unc_params = append(unc_params, 0.0)
+
+    return chi2, ndf, params, unc_params
+
+
+def fit_gauss_unbinned(data, range_fit, mu0: float, sigma0: float) -> tuple:
+    """
+    Helper method to fit data with an extended gaussian, normalised inside
+    the fit range, by minimising the unbinned negative log-likelihood as
+    RooFit does. The likelihood only depends on the data through the number
+    of entries, their sum and the sum of their squares, so that each
+    evaluation costs O(1)
+
+    Parameters
+    ------------------------------------------------
+    - data: np.ndarray
+        Data inside the fit range
+
+    - range_fit: list[float]
+        Fit range
+
+    - mu0: float
+        Initial value of the mean
+
+    - sigma0: float
+        Initial value of the width
+
+    Returns
+    ------------------------------------------------
+    - status: int
+        0 if the minimisation converged, 1 otherwise
+
+    - params: np.ndarray
+        Mean, width and normalisation
+
+    - unc_params: np.ndarray
+        Uncertainties of the parameters
+
+    - corr: np.ndarray
+        Correlation matrix of the parameters
+    """
+
+    n_entries: float = float(data.size)
+    sum1: float = float(data.sum())
+    sum2: float = float((data * data).sum())
+    xmin, xmax = range_fit
+
+    def nll(pars) -> float:
+        mu, sigma = pars
+        sum_pulls2 = (sum2 - 2 * mu * sum1 + n_entries * mu * mu) / (sigma * sigma)
+        integral = ndtr((xmax - mu) / sigma) - ndtr((xmin - mu) / sigma)
+        return 0.5 * sum_pulls2 + n_entries * log(sigma * integral)
+
+    res = minimize(
+        nll, [mu0, sigma0], method="L-BFGS-B", bounds=[(None, None), (1.0e-12, None)]
+    )
+
+    # covariance of the shape parameters from the numerical hessian
+    steps = 1.0e-4 * res.x[1] * eye(2)
+    hessian = zeros((2, 2))
+    for i in range(2):
+        for j in range(2):
+            hessian[i, j] = (
+                nll(res.x + steps[i] + steps[j])
+                - nll(res.x + steps[i] - steps[j])
+                - nll(res.x - steps[i] + steps[j])
+                + nll(res.x - steps[i] - steps[j])
+            ) / (4 * steps[i, i] * steps[j, j])
+    cov = inv(hessian)
+
+    # the normalisation of an extended single pdf is the number of entries,
+    # uncorrelated with the shape parameters
+    params = array([*res.x, n_entries])
+    unc_params = sqrt(array([cov[0, 0], cov[1, 1], n_entries]))
+    corr = eye(3)
+    corr[:2, :2] = cov / outer(unc_params[:2], unc_params[:2])
+
+    return int(not res.success), params, unc_params, corr
+
+
+def get_roofit_eval_options() -> dict:
+    """
+    Helper method to get the options of RooAbsPdf::fitTo enabling the batched
+    (vectorised) evaluation of the likelihood on CPU
+
+    Returns
+    ------------------------------------------------
+    - options: dict
+        Keyword arguments to pass to fitTo
+    """
+
+    # EvalBackend replaces BatchMode from ROOT 6.30
+    if r.gROOT.GetVersionInt() >= 63000:
+        return {"EvalBackend": "cpu"}
+    return {"BatchMode": True}
+
+
 # pylint:disable=too-many-statements, too-many-locals
 def plot_fit(config: dict) -> None:
     """
@@ -146,27 +601,31 @@ def plot_fit(config: dict) -> None:
 
     infile: r.TFile = r.TFile.Open(name_infile)
 
+    # the style only differs by the right margin from one plot to the other,
+    # it is then set once and only the right margin is changed in the loop
+    padrightmargin = 0.035  # default value
+    set_global_style(
+        padleftmargin=padleftmargin,
+        padrightmargin=padrightmargin,
+        padbottommargin=0.12,
+        padtopmargin=0.05,
+        titlesize=0.045,
+        labelsize=0.04,
+        maxdigits=3,
+    )
+
     for i, (dat, lab, func_fit) in enumerate(zip(data, label, funcs_fit)):
 
-        if "Charge" in dat:
-            padrightmargin = 0.09
-        else:
-            padrightmargin = 0.035  # default value
-        set_global_style(
-            padleftmargin=padleftmargin,
-            padrightmargin=padrightmargin,
-            padbottommargin=0.12,
-            padtopmargin=0.05,
-            titlesize=0.045,
-            labelsize=0.04,
-            maxdigits=3,
-        )
+        # larger right margin for the charge
+        r.gStyle.SetPadRightMargin(0.09 if "Charge" in dat else padrightmargin)
 
         h_data: r.TH1F = infile.Get(dat)
         h_fitres: r.TH1F = infile.Get(f"hFitRes{dat}")
 
-        chi2 = h_fitres.GetBinContent(2)
-        ndf = h_fitres.GetBinContent(3)
+        # read all the fit results at once rather than bin per bin
+        fitres: ndarray = th1_to_ndarray(h_fitres)
+        unc_fitres: ndarray = th1_errors_to_ndarray(h_fitres)
+        chi2, ndf, xmin, xmax = fitres[2:6].tolist()
         chi2_ndf = float(chi2) / ndf
 
         eq_func: str = str()
@@ -181,13 +640,9 @@ def plot_fit(config: dict) -> None:
             eq_func = "crystalball"
             npars = 5
 
-        pars, unc_pars = [], []
-        for ibin in range(6, 6 + npars):
-            pars.append(h_fitres.GetBinContent(ibin))
-            unc_pars.append(h_fitres.GetBinError(ibin))
+        pars: list[float] = fitres[6 : 6 + npars].tolist()
+        unc_pars: list[float] = unc_fitres[6 : 6 + npars].tolist()
 
-        xmin = h_fitres.GetBinContent(4)
-        xmax = h_fitres.GetBinContent(5)
         func: r.TF1 = r.TF1("func", eq_func, xmin, xmax)
         func.SetParameters(*pars)
 
@@ -271,3 +726,4 @@ def plot_fit(config: dict) -> None:
             c.Print(name_outfile)
 
     infile.Close()
+    r.gStyle.SetPadRightMargin(padrightmargin)  # back to the global style
@@ -6,6 +6,8 @@ note:
 author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
 """
 
+from functools import lru_cache
+
 
 def enforce_trailing_slash(path):
     """
@@ -43,11 +45,26 @@ def enforce_list(x) -> list[str]:
 
     if not isinstance(x, list):
         if isinstance(x, str):
-            # handle possible whitespaces in config file entry
-            x_list = x.split(",")
-            for i, element in enumerate(x_list):
-                x_list[i] = element.strip()  # remove possible whitespaces
-            return x_list
+            # a new list for each call, the caller being free to modify it
+            return list(split_entry(x))
         return [x]
 
     return x
+
+
+@lru_cache(maxsize=256)
+def split_entry(x: str) -> tuple:
+    """
+    Helper method to split a comma-separated config file entry, cached
+    since the same entries are split again and again
+
+    Parameters
+    ----------
+    - x: a string of comma-separated elements
+
+    Returns
+    ----------
+    - the elements of x, without their possible whitespaces
+    """
+
+    return tuple(element.strip() for element in x.split(","))
@@ -11,6 +11,10 @@ import ROOT
 
 # pylint: disable=too-many-branches, no-member
 
+# options of the last call of set_global_style, gStyle is left untouched when
+# the same options are set again
+_last_global_style: dict = {}
+
 
 def set_global_style(**kwargs):
     """
@@ -74,6 +78,11 @@ def set_global_style(**kwargs):
         palette for 2D plots
     """
 
+    if kwargs == _last_global_style:
+        return
+    _last_global_style.clear()
+    _last_global_style.update(kwargs)
+
     # pad margins
     padrightmargin = kwargs.get("padrightmargin", 0.035)
     padleftmargin = kwargs.get("padleftmargin", 0.12)
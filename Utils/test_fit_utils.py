@@ -0,0 +1,64 @@
+"""
+file: test_fit_utils.py
+brief: Tests of the convolutions of LanGaus in fit_utils.py
+usage: python3 -m pytest test_fit_utils.py
+note: skipped if numpy, scipy or ROOT is not installed, as fit_utils.py
+      requires them
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+pytest.importorskip("ROOT")
+
+# pylint: disable=wrong-import-position,protected-access
+from fit_utils import LanGaus, _langaus  # noqa: E402
+
+XMIN, XMAX = 5.0, 20.0  # range of the FFT grid
+# width, mp, area and sigma of LanGaus, with a Landau width above, close to
+# and below the Gaussian sigma
+PARS_LANGAUS: list[tuple] = [
+    (1.0, 10.0, 100.0, 2.0),
+    (0.2, 10.0, 100.0, 1.0),
+    (1.0, 10.0, 100.0, 0.1),
+]
+
+
+@pytest.mark.parametrize("pars", PARS_LANGAUS)
+def test_langaus_fft_matches_direct(pars):
+    """
+    The FFT convolution matches the direct one inside the range
+    """
+
+    func = LanGaus(XMIN, XMAX)
+    xs = np.linspace(XMIN, XMAX, 61)
+    values_fft = np.array([func([x], pars) for x in xs])
+    values_direct = np.array([_langaus(x, *pars) for x in xs])
+
+    assert np.max(np.abs(values_fft - values_direct)) < 1e-3 * np.max(values_direct)
+
+
+@pytest.mark.parametrize("x", [0.0, 30.0])
+def test_langaus_fft_outside_range(x):
+    """
+    Outside the range, the direct convolution is used instead of clamping
+    the interpolation to the edges of the grid
+    """
+
+    pars: tuple = PARS_LANGAUS[0]
+
+    assert LanGaus(XMIN, XMAX)([x], pars) == pytest.approx(_langaus(x, *pars))
+
+
+def test_langaus_without_smearing():
+    """
+    Without Gaussian smearing, LanGaus is the Landau density
+    """
+
+    pars: tuple = (1.0, 10.0, 100.0, 0.0)
+    value: float = LanGaus(XMIN, XMAX)([12.0], pars)
+
+    assert np.isfinite(value)
+    assert value == pytest.approx(_langaus(12.0, *pars))
@@ -13,54 +13,17 @@ try:
 except ModuleNotFoundError:
     print("Module 'root' is not installed. Please install it to run this script.")
 
-import pandas as pd
-import uproot
-
-
-def enforce_trailing_slash(path):
-    """
-    Helper method to enforce '/' at the and of directory name
-
-    Parameters
-    ------------------------------------------------
-    - path: str
-        Some path
-
-    Returns
-    ------------------------------------------------
-    - path: str
-        Path with a trailing slash at the end if it was not there yet
-    """
-
-    if path is not None and path[-1] != "/":
-        path += "/"
-
-    return path
-
-
-def enforce_list(x) -> list[str]:
-    """
-    Helper method to enforce list type
-
-    Parameters
-    ----------
-    - x: a string or a list of string
-
-    Returns
-    ----------
-    - x_list if x was not a list, x itself otherwise
-    """
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    print("Module 'numpy' is not installed. Please install it to run this script.")
 
-    if not isinstance(x, list):
-        if isinstance(x, str):
-            # handle possible whitespaces in config file entry
-            x_list = x.split(",")
-            for i, element in enumerate(x_list):
-                x_list[i] = element.strip()  # remove possible whitespaces
-            return x_list
-        return [x]
+# the format helpers are defined in format_utils, which does not require ROOT,
+# and imported here for the scripts importing them from utils
+# pylint: disable=unused-import
+from format_utils import enforce_list, enforce_trailing_slash
 
-    return x
+# pylint: enable=unused-import
 
 
 def get_h_config(cfg: dict, idx: int) -> tuple:
@@ -93,7 +56,14 @@ def get_h_config(cfg: dict, idx: int) -> tuple:
 
 # pylint: disable=too-many-arguments
 def configure_canvas(
-    name_canvas, x_min, y_axis_min, x_max, y_axis_max, title, log_y_axis=False
+    name_canvas,
+    x_min,
+    y_axis_min,
+    x_max,
+    y_axis_max,
+    title,
+    log_y_axis=False,
+    canvas=None,
 ):
     """
     Helper method to configure canvas
@@ -107,13 +77,20 @@ def configure_canvas(
     - y_axis_max: upper limit of y axis
     - title: title of the canvas
     - log_y_axis: switch for log scale along y axis
+    - canvas: TCanvas instance to clear and reuse, a new one is created if None
 
     Returns
     ----------
     - c: TCanvas instance
     """
 
-    c = r.TCanvas(name_canvas, "", 800, 800)
+    if canvas is None:
+        c = r.TCanvas(name_canvas, "", 800, 800)
+    else:
+        c = canvas
+        c.Clear()
+        c.SetName(name_canvas)
+        c.UseCurrentStyle()  # margins of the current style
     c.DrawFrame(x_min, y_axis_min, x_max, y_axis_max, title)
     if log_y_axis:
         c.SetLogy()
@@ -121,16 +98,71 @@ def configure_canvas(
     return c
 
 
-def fill_th1(col, config) -> r.TH1D:
+def th1_to_ndarray(hist) -> np.ndarray:
+    """
+    Helper method to get the contents of a histogram as a numpy array, in
+    a single call instead of one call per bin
+
+    Parameters
+    ------------------------------------------------
+    - hist: r.TH1
+        histogram, with contents stored as float or double
+
+    Returns
+    ------------------------------------------------
+    - contents: np.ndarray
+        view of the contents of all the cells, underflow and overflow
+        included, following the changes of the histogram
+    """
+
+    buffer_contents = hist.GetArray()
+
+    return np.frombuffer(
+        buffer_contents, dtype=buffer_contents.typecode, count=hist.GetNcells()
+    )
+
+
+def th1_errors_to_ndarray(hist) -> np.ndarray:
+    """
+    Helper method to get the errors of a histogram as a numpy array, in
+    a single call instead of one call per bin
+
+    Parameters
+    ------------------------------------------------
+    - hist: r.TH1
+        histogram, with contents stored as float or double
+
+    Returns
+    ------------------------------------------------
+    - errors: np.ndarray
+        errors of all the cells, underflow and overflow included, as given
+        by GetBinError with the default (normal) error option
+    """
+
+    # without sum of squares of weights, the errors are the square root of the
+    # contents, as in GetBinError
+    if hist.GetSumw2N() == 0:
+        return np.sqrt(np.abs(th1_to_ndarray(hist)))
+
+    return np.sqrt(
+        np.frombuffer(
+            hist.GetSumw2().GetArray(), dtype=np.float64, count=hist.GetNcells()
+        )
+    )
+
+
+def fill_th1(col, config, hist=None) -> r.TH1D:
     """
     Helper task to create and fill TH1 histogram
 
     Parameters
     ------------------------------------------------
     - col:
-        dataframe column
+        numpy array or dataframe column
     - config:
         config of histogram
+    - hist: r.TH1D
+        histogram to append the entries to, created from config if None
 
     Returns
     ------------------------------------------------
@@ -138,12 +170,49 @@ def fill_th1(col, config) -> r.TH1D:
         1D histogram
     """
 
-    hist = r.TH1D(*config)
-    for entry in col.to_numpy():
-        hist.Fill(entry)
-
-    hist.Sumw2()
-    hist.SetDirectory(0)
+    if hist is None:
+        hist = r.TH1D(*config)
+        hist.Sumw2()
+        hist.SetDirectory(0)
+
+    entries = np.ascontiguousarray(col, dtype=np.float64)
+    if entries.size == 0:
+        return hist
+
+    axis = hist.GetXaxis()
+    if axis.IsVariableBinSize():
+        # fill all the entries at once in C++ from a contiguous buffer
+        hist.FillN(entries.size, entries, np.ones(entries.size, dtype=np.float64))
+        return hist
+
+    # pre-bin the entries with the same formula as TAxis::FindFixBin, bins 0
+    # and nbin + 1 being the underflow and overflow
+    nbin: int = axis.GetNbins()
+    xmin: float = axis.GetXmin()
+    xmax: float = axis.GetXmax()
+    in_range = (entries >= xmin) & (entries < xmax)
+    entries_in_range = entries[in_range]
+    idx_bins = np.where(entries < xmin, 0, nbin + 1)
+    idx_bins[in_range] = 1 + (
+        nbin * (entries_in_range - xmin) / (xmax - xmin)
+    ).astype(np.int64)
+    counts = np.bincount(idx_bins, minlength=nbin + 2).astype(np.float64)
+
+    # SetContent resets the statistics, they are then updated by hand
+    n_entries: float = hist.GetEntries() + entries.size
+    stats = np.zeros(4)
+    hist.GetStats(stats)
+    stats += (
+        entries_in_range.size,
+        entries_in_range.size,
+        entries_in_range.sum(),
+        np.square(entries_in_range).sum(),
+    )
+    contents = counts + th1_to_ndarray(hist)
+    hist.SetContent(contents)
+    hist.SetError(np.sqrt(contents))  # unit weights, sumw2 = contents
+    hist.PutStats(stats)
+    hist.SetEntries(n_entries)
 
     return hist
 
@@ -160,10 +229,19 @@ def fill_th2(colx, coly, config) -> r.TH2D:
     """
 
     hist = r.TH2D(*config)
-    for x, y in zip(colx.to_numpy(), coly.to_numpy()):
-        hist.Fill(x, y)
-
     hist.Sumw2()
+
+    # fill all the entries at once in C++ from contiguous buffers
+    entries_x = np.ascontiguousarray(colx, dtype=np.float64)
+    entries_y = np.ascontiguousarray(coly, dtype=np.float64)
+    if entries_x.size > 0:
+        hist.FillN(
+            entries_x.size,
+            entries_x,
+            entries_y,
+            np.ones(entries_x.size, dtype=np.float64),
+        )
+
     return hist
 
 
@@ -179,20 +257,21 @@ def scan_peaks(content_bins):
             - then we need to access the Delta E values corresponding to the min and max values OF ENTRIES
     """
 
-    mins, maxs = [], []
-
-    for ibin, content in enumerate(content_bins):
-        if ibin == 0:
-            mins.append((ibin, content))
-            continue
-        if ibin == len(content_bins) - 1:
-            continue
-        if content_bins[ibin - 1] < content and content > content_bins[ibin + 1]:
-            maxs.append((ibin, content))
-            continue
-        if content_bins[ibin - 1] > content and content < content_bins[ibin + 1]:
-            mins.append((ibin, content))
-            continue
+    contents = np.asarray(content_bins, dtype=np.float64)
+    if contents.size == 0:
+        return [], []
+
+    # compare each bin to the next one only once, the slopes on both sides of
+    # an inner bin being shared by the search of the minima and maxima
+    steps = np.diff(contents)
+    rising, falling = steps > 0, steps < 0
+    idx_maxs = np.flatnonzero(rising[:-1] & falling[1:]) + 1
+    idx_mins = np.flatnonzero(falling[:-1] & rising[1:]) + 1
+
+    # the first bin is always considered as a minimum
+    mins = [(0, content_bins[0])]
+    mins += zip(idx_mins.tolist(), contents[idx_mins].tolist())
+    maxs = list(zip(idx_maxs.tolist(), contents[idx_maxs].tolist()))
 
     return mins, maxs
 
@@ -210,11 +289,11 @@ def qa_plot_hist_and_extrema(h, mins, maxs, binning, inrj):
     h_config_maxs = (f"{title}_maxs", "", len(binning) - 1, binning)
     h_mins = r.TH1D(*h_config_mins)
     h_maxs = r.TH1D(*h_config_maxs)
-    # fill histograms
-    for _, (ibin, min) in enumerate(mins):
-        h_mins.SetBinContent(ibin + 1, min)
-    for _, (ibin, min) in enumerate(maxs):
-        h_maxs.SetBinContent(ibin + 1, min)
+    # fill histograms, writing the contents of the extrema bins at once
+    for h_extrema, extrema in ((h_mins, mins), (h_maxs, maxs)):
+        if len(extrema) > 0:
+            idx_bins, contents = np.array(extrema, dtype=np.float64).T
+            th1_to_ndarray(h_extrema)[idx_bins.astype(np.intp) + 1] = contents
 
     # draw options
     h_mins.SetLineColor(r.kBlack)
@@ -230,74 +309,92 @@ def qa_plot_hist_and_extrema(h, mins, maxs, binning, inrj):
     return canvas
 
 
+def get_extrema_limits(arr, bin_limits) -> tuple:
+    """
+    Helper function to retrieve the lower and upper edges of the bins of
+    extrema, the extrema outside of the binning being skipped
+
+    Parameters
+    ------------------------------------------------
+    - arr:
+        list of (bin, content) of the extrema
+    - bin_limits:
+        bin edges
+
+    Returns
+    ------------------------------------------------
+    - lower_edges: np.ndarray
+        lower edge of the bin of each extremum
+    - upper_edges: np.ndarray
+        upper edge of the bin of each extremum
+    """
+
+    bin_limits = np.asarray(bin_limits)
+    idx_bins = np.fromiter((ibin for ibin, _ in arr), dtype=np.intp)
+    idx_bins = idx_bins[idx_bins < len(bin_limits) - 1]
+
+    return bin_limits[idx_bins], bin_limits[idx_bins + 1]
+
+
 def get_extrema_edges(arr, bin_limits):
     """
     Helper function to retrieve bin informations (edges and center)
     """
-    edges = []
-    for _, (i, _) in enumerate(arr):
-        if i >= len(bin_limits) - 1:
-            continue
-        lower_edge = bin_limits[i]
-        upper_edge = bin_limits[i + 1]
-        # center = (lower_edge + upper_edge) / 2
-        edges.append((lower_edge, upper_edge))
-        # edges.append(lower_edge)
-        # edges.append(upper_edge)
+    lower_edges, upper_edges = get_extrema_limits(arr, bin_limits)
 
-    return edges
+    return list(zip(lower_edges.tolist(), upper_edges.tolist()))
 
 
 def get_extrema_centers(arr, bin_limits):
     """
     Helper function to retrieve bin informations (edges and center)
     """
-    centers = []
-    for _, (i, _) in enumerate(arr):
-        if i >= len(bin_limits) - 1:
-            continue
-        lower_edge = bin_limits[i]
-        upper_edge = bin_limits[i + 1]
-        center = (lower_edge + upper_edge) / 2
-        centers.append(center)
+    lower_edges, upper_edges = get_extrema_limits(arr, bin_limits)
 
-    return centers
+    return ((lower_edges + upper_edges) / 2).tolist()
 
 
 def get_pseudo_max(h, binning, thr=7, min_consecutive_zeros=2):
     """
-    Helper function to get th
+    Helper function to get the end of a distribution, i.e. where the first
+    run of consecutive quasi empty bins starts
+
+    Parameters
+    ------------------------------------------------
+    - h: r.TH1
+        Histogram of the distribution
+    - binning:
+        Bin edges of the histogram
+    - thr: float
+        Content below which a bin is considered as quasi empty
+    - min_consecutive_zeros: int
+        Minimum number of consecutive quasi empty bins
+
+    Returns
+    ------------------------------------------------
+    - :float
+        Upper edge of the first bin of the run, last edge of the binning if
+        there is no such run
     """
-    quasi_empty_bins = []
-    nbins = len(binning)
-    print(nbins)
-    for ibin in range(1, nbins):
-        content = h.GetBinContent(ibin)
-        # check if content is below threshold
-        if content < thr:
-            quasi_empty_bins.append(ibin)
+
+    nbins: int = len(binning) - 1
+    quasi_empty_bins = th1_to_ndarray(h)[1 : nbins + 1] < thr
 
     # safety
-    if min_consecutive_zeros > len(quasi_empty_bins):
+    if min_consecutive_zeros > np.count_nonzero(quasi_empty_bins):
         print("ERROR: ...")
-        return
-    # get number of consecutive bins with zero
-    counter = 0
-    first_empty_bin = -1
-    for i, bin in enumerate(quasi_empty_bins):
-        if i == 0:
-            continue
-        # we reached the threshold !
-        if counter >= min_consecutive_zeros:
-            break
-        # check if two zeros are consercutive
-        if quasi_empty_bins[i - 1] == quasi_empty_bins[i] - 1:
-            counter += 1
-            if first_empty_bin == -1:
-                first_empty_bin = quasi_empty_bins[i - 1]
-        else:
-            first_empty_bin = -1
-    return binning[first_empty_bin]
+        return None
+
+    # starts and ends of the runs of consecutive quasi empty bins
+    changes = np.diff(np.concatenate(([0], quasi_empty_bins.astype(np.int8), [0])))
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    long_runs = np.flatnonzero(ends - starts >= min_consecutive_zeros)
+    if long_runs.size == 0:
+        return binning[-1]
+
+    # index i of quasi_empty_bins is the bin i + 1
+    return binning[starts[long_runs[0]] + 1]
 
 
 # def get_bin_info(xaxis, ibin):
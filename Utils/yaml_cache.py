@@ -0,0 +1,112 @@
+"""
+file: yaml_cache.py
+brief: Load YAML config files, caching the parsed content in memory and on disk
+usage:
+note: the cache is kept in memory for the configs loaded by the running process
+      and stored next to the config file as '<name_config_file>.pkl', both are
+      rebuilt whenever the modification time or the size of the config file
+      changes
+author: Alexandre BIGOT, alexandre.bigot@iphc.cnrs.fr
+"""
+
+import pickle
+from collections import OrderedDict
+from copy import deepcopy
+from os import stat
+
+try:
+    from yaml import load
+except ModuleNotFoundError:
+    print("Module 'pyyaml' is not installed. Please install it to run this script.")
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+MAX_SIZE_CACHE: int = 100  # maximum number of configs kept in memory
+
+# in-memory cache, config file -> (signature, config), least recently used first
+_cache: OrderedDict = OrderedDict()
+
+
+def load_yaml(name_config_file: str) -> dict:
+    """
+    Helper method to load a YAML config file, reusing the parsed content of
+    a previous call as long as the file did not change. A copy of the cached
+    content is returned, so that the caller can modify it
+
+    Parameters
+    ------------------------------------------------
+    - name_config_file: str
+        Name of the YAML config file
+
+    Returns
+    ------------------------------------------------
+    - config: dict
+        Content of the config file
+    """
+
+    stat_config = stat(name_config_file)
+    signature: tuple = (stat_config.st_mtime_ns, stat_config.st_size)
+    name_cache_file: str = name_config_file + ".pkl"
+
+    if name_config_file in _cache:
+        cached_signature, config = _cache[name_config_file]
+        if cached_signature == signature:
+            _cache.move_to_end(name_config_file)
+            return deepcopy(config)
+
+    config: dict = _load_from_disk(name_config_file, name_cache_file, signature)
+
+    _cache[name_config_file] = (signature, config)
+    _cache.move_to_end(name_config_file)
+    if len(_cache) > MAX_SIZE_CACHE:
+        _cache.popitem(last=False)
+
+    return deepcopy(config)
+
+
+def _load_from_disk(
+    name_config_file: str, name_cache_file: str, signature: tuple
+) -> dict:
+    """
+    Helper method to load a YAML config file from the pickled cache on disk,
+    parsing it again if the cache is missing or outdated
+
+    Parameters
+    ------------------------------------------------
+    - name_config_file: str
+        Name of the YAML config file
+
+    - name_cache_file: str
+        Name of the pickled cache of the config file
+
+    - signature: tuple
+        Modification time and size of the config file
+
+    Returns
+    ------------------------------------------------
+    - config: dict
+        Content of the config file
+    """
+
+    try:
+        with open(name_cache_file, "rb") as cache_file:
+            cached_signature, config = pickle.load(cache_file)
+        if cached_signature == signature:
+            return config
+    except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError):
+        pass
+
+    config: dict = {}
+    with open(name_config_file, "r", encoding="utf-8") as yml_config_file:
+        config = load(yml_config_file, Loader=Loader)
+
+    try:
+        with open(name_cache_file, "wb") as cache_file:
+            pickle.dump((signature, config), cache_file, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # read-only location, simply do not cache
+
+    return config